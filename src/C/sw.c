@@ -1,56 +1,539 @@
 #include <stdlib.h>
 #include <string.h>
 #include <stdio.h>
+#include <limits.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#include <emmintrin.h>
+#include <immintrin.h>
+#define SW_X86 1
+#endif
 
-#define M 64
-#define N 64
 #define MAX(x,y) (((x) > (y)) ? (x) : (y))
+#define MIN(x,y) (((x) < (y)) ? (x) : (y))
+#define LANES 32
+
+/*
+ * The DP only ever needs the previous row, so instead of a full matrix we
+ * keep a single row of cells (one per qSeq base) which is grown on demand.
+ * This bounds neither the query nor the target length and the row of a
+ * barcode-sized qSeq stays in L1.
+ */
+typedef struct {
+    int* row;
+    int  size;
+} dp_mat;
 
-int* allocate_dp_mat() {
-    return (int*) calloc(N*M, sizeof(int));
+dp_mat* allocate_dp_mat() {
+    return (dp_mat*) calloc(1, sizeof(dp_mat));
+}
+
+void free_dp_mat(dp_mat* dp) {
+    if (dp) {
+	free(dp->row);
+	free(dp);
+    }
 }
 
-int compute_align_score(int* dp_mat, char* tSeq, char* qSeq) {
+int compute_align_score(dp_mat* dp, char* tSeq, char* qSeq) {
     int ipenalty   = -1;
     int dpenalty   = -1;
     int match      =  2;
     int mpenalty   = -2;
     int best_score = 0;
-    int iscore     = 0;
-    int dscore     = 0;
-    int mscore     = 0;
+    int t_len      = strlen(tSeq);
+    int q_len      = strlen(qSeq);
+    int diag, left, h;
     int i,j;
 
-    memset(dp_mat, 0, M*N*sizeof(int));
+    if (dp->size < q_len + 1) {
+	free(dp->row);
+	dp->size = q_len + 1;
+	dp->row  = (int*) malloc(dp->size * sizeof(int));
+    }
+    memset(dp->row, 0, (q_len + 1) * sizeof(int));
 
-    for (i = 1; i < strlen(tSeq) + 1; i++) {
-	for (j = 1; j < strlen(qSeq) + 1; j++) {
-	    iscore = dp_mat[i*M + j-1] + ipenalty;
-	    dscore = dp_mat[(i-1)*M + j] + dpenalty;
-	    mscore = dp_mat[(i-1)*M + j-1] + ((tSeq[i-1] == qSeq[j-1]) ? match : mpenalty);
-	    dp_mat[i*M + j] = MAX(MAX(0, iscore), MAX(dscore, mscore));
- 	    if (dp_mat[i*M + j] >= best_score) 
-		best_score = dp_mat[i*M + j];
+    for (i = 1; i < t_len + 1; i++) {
+	diag = 0;
+	left = 0;
+	for (j = 1; j < q_len + 1; j++) {
+	    /* dp->row[j] still holds row i-1 here */
+	    h = diag + ((tSeq[i-1] == qSeq[j-1]) ? match : mpenalty);
+	    h = MAX(MAX(0, h), MAX(left + ipenalty, dp->row[j] + dpenalty));
+	    diag = dp->row[j];
+	    dp->row[j] = left = h;
+	    best_score = MAX(best_score, h);
 	}
     }
     return best_score;
 }
 
-void compute_align_scores(int* scores, int n, int* dp_mat, char* tSeq, 
+void compute_align_scores(int* scores, int n, dp_mat* dp, char* tSeq,
                           char** qSeqs) {
-    int i = 0;
-    for (i; i < n; i++) {
-        scores[i] = compute_align_score(dp_mat, tSeq, qSeqs[i]);
+    int i;
+    for (i = 0; i < n; i++) {
+        scores[i] = compute_align_score(dp, tSeq, qSeqs[i]);
     }
 }
 
 
-void print_dp_mat(int* dp_mat, char* tSeq, char* qSeq) {
-    int i,j;
-    for (j = 0; j < strlen(qSeq) + 1; j++) {
-    	for (i = 0; i < strlen(tSeq) + 1; i++) {
-    	    printf("%d ", dp_mat[i*M + j]);
-    	}
-    	printf("\n");
+/*
+ * Barcode sets: score one query against many barcodes at once.
+ *
+ * Barcodes and queries are encoded sequences of one base code per byte (A,
+ * C, G and T are 0 to 3 and any other base 4), passed packed back to back
+ * with their offsets, so no lengths are ever recomputed.
+ *
+ * The barcodes are interleaved into a profile of LANES barcodes per group,
+ * so that row i of a group holds base i of each of its barcodes.  Each SIMD
+ * lane then runs the DP of one barcode while the query is walked once per
+ * group.  Short barcodes (and the unused lanes of the last group) are padded
+ * with PAD, which never matches a base code; since the padding only trails
+ * the real sequence it cannot raise a local alignment score.
+ *
+ * Cells are kept in saturating unsigned 8-bit lanes when the best possible
+ * score (2 * min(barcode, query)) fits, in 16-bit lanes otherwise, and the
+ * scalar kernel is used when neither SSE2 nor AVX2 is available.
+ *
+ * A set is read-only once made and the DP columns live in scratch space
+ * owned by each call, so one set may be scored from many threads at once
+ * (ctypes releases the GIL for the duration of the call).
+ */
+
+#define SIMD_SCALAR 0
+#define SIMD_SSE2   1
+#define SIMD_AVX2   2
+#define PAD         0xFF
+
+typedef struct {
+    int n;
+    int max_len;
+    int n_groups;
+    unsigned char* profile;
+} barcode_set;
+
+static int simd = -1;
+
+static int detect_simd_level() {
+#ifdef SW_X86
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2"))
+        return SIMD_AVX2;
+    if (__builtin_cpu_supports("sse2"))
+        return SIMD_SSE2;
+#endif
+    return SIMD_SCALAR;
+}
+
+int simd_level() {
+    if (simd < 0)
+        simd = detect_simd_level();
+    return simd;
+}
+
+/* Restrict the kernels to at most 'level', e.g. to compare them. */
+int set_simd_level(int level) {
+    simd = MIN(level, detect_simd_level());
+    return simd;
+}
+
+/* Barcode b is at [offsets[b], offsets[b+1]) in 'seqs'. */
+barcode_set* make_barcode_set(unsigned char* seqs, int* offsets, int n) {
+    barcode_set* set = (barcode_set*) calloc(1, sizeof(barcode_set));
+    int b, i;
+
+    set->n = n;
+    for (b = 0; b < n; b++)
+	set->max_len = MAX(set->max_len, offsets[b+1] - offsets[b]);
+    set->n_groups = (n + LANES - 1) / LANES;
+    set->profile  = (unsigned char*) malloc(set->n_groups * set->max_len * LANES);
+    memset(set->profile, PAD, set->n_groups * set->max_len * LANES);
+
+    for (b = 0; b < n; b++) {
+	for (i = 0; i < offsets[b+1] - offsets[b]; i++)
+	    set->profile[((b / LANES) * set->max_len + i) * LANES + b % LANES] =
+		seqs[offsets[b] + i];
+    }
+    return set;
+}
+
+void free_barcode_set(barcode_set* set) {
+    if (set) {
+	free(set->profile);
+	free(set);
+    }
+}
+
+/*
+ * Banding: when the barcode is expected to start 'diag' bases into the query
+ * only the cells within 'band' diagonals of that one are filled, the others
+ * are left at 0 (so a banded score never exceeds the full one).  The band
+ * moves down one row per query base, hence the cells entering it at the
+ * bottom are still 0 and the ones leaving it at the top are never read again.
+ * Once the band has moved past the last row, lo is len + 1 and the column is
+ * empty; row lo - 1 is still read as the diagonal, so lo never goes further.
+ * A negative band fills the whole matrix.
+ */
+static void band_rows(int j, int len, int diag, int band, int* lo, int* hi) {
+    if (band < 0) {
+	*lo = 1;
+	*hi = len;
+    } else {
+	*lo = MIN(len + 1, MAX(1, j + 1 - diag - band));
+	*hi = MIN(len, j + 1 - diag + band);
+    }
+}
+
+static long long band_cells(int len, int q_len, int diag, int band) {
+    long long cells = 0;
+    int j, lo, hi;
+    for (j = 0; j < q_len; j++) {
+	band_rows(j, len, diag, band, &lo, &hi);
+	cells += MAX(0, hi - lo + 1);
+    }
+    return cells;
+}
+
+/*
+ * Pruning: every alignment still to come either runs through a cell of the
+ * current column or starts after it, and each remaining query base adds at
+ * most 2, so once column j is done no lane can score more than
+ * max(best, column max + 2 * remaining).  Given a 'floor' per lane, a kernel
+ * stops as soon as that bound is below the floor of each of its lanes and
+ * reports the bound as their score; lanes reaching their floor are exact.
+ *
+ * Each kernel scores the lanes of one group starting at 'prof', of which only
+ * the first n are used, and returns the number of cells it filled for them.
+ */
+static int reach_bound(int best, int col_max, int remaining) {
+    return MAX(best, col_max + 2 * remaining);
+}
+
+static long long score_group_scalar(int* best, const unsigned char* prof, int len,
+				    const unsigned char* query, int q_len, int d0, int band,
+				    const int* floor, int n, int* col) {
+    long long cells = 0;
+    int lane, i, j, lo, hi, diag, h, col_max;
+
+    for (lane = 0; lane < n; lane++) {
+	best[lane] = 0;
+	memset(col, 0, (len + 1) * sizeof(int));
+	for (j = 0; j < q_len; j++) {
+	    band_rows(j, len, d0, band, &lo, &hi);
+	    diag = col[lo-1];
+	    col_max = 0;
+	    for (i = lo; i <= hi; i++) {
+		h = diag + ((prof[(i-1)*LANES + lane] == query[j]) ? 2 : -2);
+		h = MAX(MAX(0, h), MAX((i > lo ? col[i-1] : 0) - 1, col[i] - 1));
+		diag = col[i];
+		col[i] = h;
+		col_max = MAX(col_max, h);
+	    }
+	    cells += MAX(0, hi - lo + 1);
+	    best[lane] = MAX(best[lane], col_max);
+	    if (floor && reach_bound(best[lane], col_max, q_len - j - 1) < floor[lane]) {
+		best[lane] = reach_bound(best[lane], col_max, q_len - j - 1);
+		break;
+	    }
+	}
+    }
+    return cells;
+}
+
+#ifdef SW_X86
+/* 16 lanes of unsigned 8-bit cells; 'prof' points at the first lane. */
+static long long score_lanes_sse2_u8(int* best, const unsigned char* prof, int len,
+				     const unsigned char* query, int q_len, int d0, int band,
+				     const int* floor, int n, unsigned char* col) {
+    __m128i two = _mm_set1_epi8(2), one = _mm_set1_epi8(1);
+    __m128i vbest = _mm_setzero_si128();
+    __m128i vfloor = _mm_setzero_si128();
+    __m128i qc, diag, up, left, eq, h, cmax, reach;
+    unsigned char out[16];
+    int i, j, lo, hi, cols = q_len;
+
+    if (floor) {
+	for (i = 0; i < 16; i++)
+	    out[i] = MAX(0, MIN(255, floor[i]));
+	vfloor = _mm_loadu_si128((__m128i*) out);
+    }
+    memset(col, 0, (len + 1) * 16);
+    for (j = 0; j < q_len; j++) {
+	qc   = _mm_set1_epi8(query[j]);
+	band_rows(j, len, d0, band, &lo, &hi);
+	diag = _mm_loadu_si128((__m128i*) (col + (lo-1)*16));
+	up   = _mm_setzero_si128();
+	cmax = _mm_setzero_si128();
+	for (i = lo; i <= hi; i++) {
+	    left = _mm_loadu_si128((__m128i*) (col + i*16));
+	    eq   = _mm_cmpeq_epi8(_mm_loadu_si128((__m128i*) (prof + (i-1)*LANES)), qc);
+	    h    = _mm_subs_epu8(_mm_adds_epu8(diag, _mm_and_si128(eq, two)),
+				 _mm_andnot_si128(eq, two));
+	    h    = _mm_max_epu8(h, _mm_max_epu8(_mm_subs_epu8(up, one),
+						 _mm_subs_epu8(left, one)));
+	    cmax = _mm_max_epu8(cmax, h);
+	    _mm_storeu_si128((__m128i*) (col + i*16), h);
+	    diag = left;
+	    up   = h;
+	}
+	vbest = _mm_max_epu8(vbest, cmax);
+	if (floor) {
+	    reach = _mm_max_epu8(vbest, _mm_adds_epu8(cmax,
+				 _mm_set1_epi8(MIN(255, 2 * (q_len - j - 1)))));
+	    if (!_mm_movemask_epi8(_mm_cmpeq_epi8(_mm_max_epu8(reach, vfloor), reach))) {
+		vbest = reach;
+		cols  = j + 1;
+		break;
+	    }
+	}
+    }
+    _mm_storeu_si128((__m128i*) out, vbest);
+    for (i = 0; i < 16; i++)
+	best[i] = out[i];
+    return band_cells(len, cols, d0, band) * n;
+}
+
+/* 8 lanes of signed 16-bit cells, for scores that overflow a byte. */
+static long long score_lanes_sse2_i16(int* best, const unsigned char* prof, int len,
+				      const unsigned char* query, int q_len, int d0, int band,
+				      const int* floor, int n, unsigned char* col) {
+    __m128i zero = _mm_setzero_si128();
+    __m128i match = _mm_set1_epi16(2), mismatch = _mm_set1_epi16(-2);
+    __m128i one = _mm_set1_epi16(1);
+    __m128i vbest = zero, vfloor = zero;
+    __m128i qc, diag, up, left, eq, h, cmax, reach;
+    short out[8];
+    int i, j, lo, hi, cols = q_len;
+
+    if (floor) {
+	for (i = 0; i < 8; i++)
+	    out[i] = MAX(0, MIN(32767, floor[i]));
+	vfloor = _mm_loadu_si128((__m128i*) out);
+    }
+    memset(col, 0, (len + 1) * 16);
+    for (j = 0; j < q_len; j++) {
+	qc   = _mm_set1_epi16(query[j]);
+	band_rows(j, len, d0, band, &lo, &hi);
+	diag = _mm_loadu_si128((__m128i*) (col + (lo-1)*16));
+	up   = zero;
+	cmax = zero;
+	for (i = lo; i <= hi; i++) {
+	    left = _mm_loadu_si128((__m128i*) (col + i*16));
+	    eq   = _mm_cmpeq_epi16(_mm_unpacklo_epi8(
+		       _mm_loadl_epi64((__m128i*) (prof + (i-1)*LANES)), zero), qc);
+	    h    = _mm_adds_epi16(diag, _mm_or_si128(_mm_and_si128(eq, match),
+						     _mm_andnot_si128(eq, mismatch)));
+	    h    = _mm_max_epi16(_mm_max_epi16(h, zero),
+				 _mm_max_epi16(_mm_subs_epi16(up, one),
+					       _mm_subs_epi16(left, one)));
+	    cmax = _mm_max_epi16(cmax, h);
+	    _mm_storeu_si128((__m128i*) (col + i*16), h);
+	    diag = left;
+	    up   = h;
+	}
+	vbest = _mm_max_epi16(vbest, cmax);
+	if (floor) {
+	    reach = _mm_max_epi16(vbest, _mm_adds_epi16(cmax,
+				  _mm_set1_epi16(MIN(32767, 2 * (q_len - j - 1)))));
+	    if (_mm_movemask_epi8(_mm_cmpgt_epi16(vfloor, reach)) == 0xFFFF) {
+		vbest = reach;
+		cols  = j + 1;
+		break;
+	    }
+	}
+    }
+    _mm_storeu_si128((__m128i*) out, vbest);
+    for (i = 0; i < 8; i++)
+	best[i] = out[i];
+    return band_cells(len, cols, d0, band) * n;
+}
+
+/* 32 lanes of unsigned 8-bit cells, i.e. a whole group at once. */
+__attribute__((target("avx2")))
+static long long score_lanes_avx2_u8(int* best, const unsigned char* prof, int len,
+				     const unsigned char* query, int q_len, int d0, int band,
+				     const int* floor, int n, unsigned char* col) {
+    __m256i two = _mm256_set1_epi8(2), one = _mm256_set1_epi8(1);
+    __m256i vbest = _mm256_setzero_si256();
+    __m256i vfloor = _mm256_setzero_si256();
+    __m256i qc, diag, up, left, eq, h, cmax, reach;
+    unsigned char out[32];
+    int i, j, lo, hi, cols = q_len;
+
+    if (floor) {
+	for (i = 0; i < 32; i++)
+	    out[i] = MAX(0, MIN(255, floor[i]));
+	vfloor = _mm256_loadu_si256((__m256i*) out);
+    }
+    memset(col, 0, (len + 1) * 32);
+    for (j = 0; j < q_len; j++) {
+	qc   = _mm256_set1_epi8(query[j]);
+	band_rows(j, len, d0, band, &lo, &hi);
+	diag = _mm256_loadu_si256((__m256i*) (col + (lo-1)*32));
+	up   = _mm256_setzero_si256();
+	cmax = _mm256_setzero_si256();
+	for (i = lo; i <= hi; i++) {
+	    left = _mm256_loadu_si256((__m256i*) (col + i*32));
+	    eq   = _mm256_cmpeq_epi8(_mm256_loadu_si256((__m256i*) (prof + (i-1)*LANES)), qc);
+	    h    = _mm256_subs_epu8(_mm256_adds_epu8(diag, _mm256_and_si256(eq, two)),
+				    _mm256_andnot_si256(eq, two));
+	    h    = _mm256_max_epu8(h, _mm256_max_epu8(_mm256_subs_epu8(up, one),
+						       _mm256_subs_epu8(left, one)));
+	    cmax = _mm256_max_epu8(cmax, h);
+	    _mm256_storeu_si256((__m256i*) (col + i*32), h);
+	    diag = left;
+	    up   = h;
+	}
+	vbest = _mm256_max_epu8(vbest, cmax);
+	if (floor) {
+	    reach = _mm256_max_epu8(vbest, _mm256_adds_epu8(cmax,
+				    _mm256_set1_epi8(MIN(255, 2 * (q_len - j - 1)))));
+	    if (!_mm256_movemask_epi8(_mm256_cmpeq_epi8(_mm256_max_epu8(reach, vfloor),
+							reach))) {
+		vbest = reach;
+		cols  = j + 1;
+		break;
+	    }
+	}
+    }
+    _mm256_storeu_si256((__m256i*) out, vbest);
+    for (i = 0; i < 32; i++)
+	best[i] = out[i];
+    return band_cells(len, cols, d0, band) * n;
+}
+#endif
+
+/* Score the first n lanes of a group, see the kernels above. */
+static long long score_group(int* best, const unsigned char* prof, int len,
+			     const unsigned char* query, int q_len, int d0, int band,
+			     const int* floor, int n, unsigned char* scratch) {
+#ifdef SW_X86
+    long long cells = 0;
+    int lane;
+    if (2 * MIN(len, q_len) < 255) {
+	if (simd_level() >= SIMD_AVX2) {
+	    return score_lanes_avx2_u8(best, prof, len, query, q_len, d0, band,
+				       floor, n, scratch);
+	} else if (simd_level() >= SIMD_SSE2) {
+	    for (lane = 0; lane < n; lane += 16)
+		cells += score_lanes_sse2_u8(best + lane, prof + lane, len, query, q_len,
+					     d0, band, floor ? floor + lane : NULL,
+					     MIN(16, n - lane), scratch);
+	    return cells;
+	}
+    } else if (2 * MIN(len, q_len) < 32767 && simd_level() >= SIMD_SSE2) {
+	for (lane = 0; lane < n; lane += 8)
+	    cells += score_lanes_sse2_i16(best + lane, prof + lane, len, query, q_len,
+					  d0, band, floor ? floor + lane : NULL,
+					  MIN(8, n - lane), scratch);
+	return cells;
+    }
+#endif
+    return score_group_scalar(best, prof, len, query, q_len, d0, band, floor, n,
+			      (int*) scratch);
+}
+
+/* One DP column of 16-bit cells for a whole group, followed by room for the
+ * profile of a group of gathered candidates */
+static unsigned char* make_scratch(const barcode_set* set) {
+    return (unsigned char*) malloc((set->max_len + 1) * LANES * sizeof(short) +
+				   set->max_len * LANES);
+}
+
+static long long score_query(int* scores, const barcode_set* set,
+			     const unsigned char* query, int q_len, int d0, int band,
+			     unsigned char* scratch) {
+    long long cells = 0;
+    int best[LANES];
+    int g, n;
+
+    for (g = 0; g < set->n_groups; g++) {
+	n = MIN(LANES, set->n - g * LANES);
+	cells += score_group(best, set->profile + g * set->max_len * LANES, set->max_len,
+			     query, q_len, d0, band, NULL, n, scratch);
+	memcpy(scores + g * LANES, best, n * sizeof(int));
+    }
+    return cells;
+}
+
+/* Like score_query, but only for the barcodes listed in 'candidates', whose
+ * profile columns are first gathered into groups of their own; negative
+ * entries are skipped.  The candidates are pruned against 'floors' (see the
+ * kernels) when given, and the scores of the other barcodes are left
+ * untouched. */
+static long long score_candidates(int* scores, const barcode_set* set,
+				  const int* candidates, const int* floors,
+				  int n_candidates, const unsigned char* query, int q_len,
+				  int d0, int band, unsigned char* scratch) {
+    unsigned char* prof = scratch + (set->max_len + 1) * LANES * sizeof(short);
+    const unsigned char* src;
+    long long cells = 0;
+    int ids[LANES], floor[LANES], best[LANES];
+    int c, i, b, n = 0;
+
+    for (c = 0; c < n_candidates; c++) {
+	if (candidates[c] >= 0) {
+	    ids[n]     = candidates[c];
+	    floor[n++] = floors ? floors[c] : 0;
+	}
+	if (n == LANES || (n > 0 && c == n_candidates - 1)) {
+	    memset(prof, PAD, set->max_len * LANES);
+	    for (b = 0; b < n; b++) {
+		src = set->profile + (ids[b] / LANES) * set->max_len * LANES + ids[b] % LANES;
+		for (i = 0; i < set->max_len; i++)
+		    prof[i*LANES + b] = src[i*LANES];
+	    }
+	    for (b = n; b < LANES; b++)
+		floor[b] = INT_MAX;
+	    cells += score_group(best, prof, set->max_len, query, q_len, d0, band,
+				 floors ? floor : NULL, n, scratch);
+	    for (b = 0; b < n; b++)
+		scores[ids[b]] = best[b];
+	    n = 0;
+	}
+    }
+    return cells;
+}
+
+void compute_set_scores(int* scores, barcode_set* set, unsigned char* query,
+			int q_len) {
+    unsigned char* scratch = make_scratch(set);
+    score_query(scores, set, query, q_len, 0, -1, scratch);
+    free(scratch);
+}
+
+/* Score n_queries queries, packed back to back in 'queries' with query k at
+ * [offsets[k], offsets[k+1]), into the row-major (n_queries, set->n) matrix
+ * 'scores'.  Empty queries score 0 against every barcode.  If 'diagonals' is
+ * given, query k is banded around diagonals[k] with a width of bands[k] (see
+ * band_rows).  If 'candidates' is given, only the barcodes in row k of that
+ * (n_queries, n_candidates) matrix are scored for query k, pruned against the
+ * matching row of 'floors' if that is given too.  Returns the number of DP
+ * cells filled. */
+long long compute_set_scores_batch(int* scores, barcode_set* set,
+				   unsigned char* queries, int* offsets,
+				   int* diagonals, int* bands,
+				   int* candidates, int* floors, int n_candidates,
+				   int n_queries) {
+    unsigned char* scratch = make_scratch(set);
+    long long cells = 0;
+    int k;
+
+    for (k = 0; k < n_queries; k++) {
+	if (candidates) {
+	    cells += score_candidates(scores + k * set->n, set,
+				      candidates + k * n_candidates,
+				      floors ? floors + k * n_candidates : NULL, n_candidates,
+				      queries + offsets[k], offsets[k+1] - offsets[k],
+				      diagonals ? diagonals[k] : 0,
+				      diagonals ? bands[k] : -1, scratch);
+	} else {
+	    cells += score_query(scores + k * set->n, set, queries + offsets[k],
+				 offsets[k+1] - offsets[k],
+				 diagonals ? diagonals[k] : 0,
+				 diagonals ? bands[k] : -1, scratch);
+	}
     }
+    free(scratch);
+    return cells;
 }
@@ -0,0 +1,134 @@
+#################################################################################$$
+# Copyright (c) 2011,2012, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR ITS
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################$$
+
+import h5py as h5
+import numpy as np
+
+from pbbarcode.utils import Bunch
+
+# Paths to the Barcode Datasets in the bc.h5 file, as read by
+#    pbcore.io.BarcodeH5Reader
+BC_DS_PATH     = "BarcodeCalls/best"
+BC_DS_ALL_PATH = "BarcodeCalls/all"
+
+BEST_COLUMNS = ['holeNumber', 'nAdapters', 'barcodeIdx1', 'barcodeScore1',
+                'barcodeIdx2', 'barcodeScore2']
+ALL_COLUMNS  = ['holeNumber', 'adapterIdx', 'barcodeIdx', 'score']
+
+class BarcodeH5Writer(object):
+    """Write a bc.h5 file one LabeledZmwTable (a chunk of labeled ZMWs) at a
+    time, in the layout of pbcore's writeBarcodeH5.  The datasets are
+    created empty and resized as each chunk is appended, and the file is
+    flushed after every chunk, so only one chunk is ever held in memory and
+    the file of a job killed part way through still holds every chunk
+    written before."""
+    def __init__(self, fileName, labeler, writeExtendedInfo = False,
+                 chunkSize = 1000):
+        self.h5File = h5.File(fileName, 'a')
+        self.writeExtendedInfo = writeExtendedInfo
+        self.numSeqs = len(labeler.barcodeNames)
+
+        self.bestDS = self._createDataset(BC_DS_PATH, BEST_COLUMNS, chunkSize)
+        self.bestDS.attrs['movieName'] = labeler.movieName
+        self.bestDS.attrs['barcodes'] = np.array(labeler.barcodeLabels)
+        self.bestDS.attrs['columnNames'] = np.array(BEST_COLUMNS)
+        self.bestDS.attrs['scoreMode'] = labeler.scoreMode
+        self.bestDS.attrs['stopMargin'] = getattr(labeler, 'stopMargin', 0)
+
+        if writeExtendedInfo:
+            # Each barcode is scored individually, hence names versus labels
+            self.allDS = self._createDataset(BC_DS_ALL_PATH, ALL_COLUMNS,
+                                             chunkSize * self.numSeqs)
+            self.allDS.attrs['movieName'] = labeler.movieName
+            self.allDS.attrs['barcodes'] = np.array(labeler.barcodeNames)
+            self.allDS.attrs['columnNames'] = np.array(ALL_COLUMNS)
+        self.h5File.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _createDataset(self, path, columns, chunkRows):
+        if path in self.h5File:
+            del self.h5File[path]
+        return self.h5File.create_dataset(path, shape = (0, len(columns)),
+                                          maxshape = (None, len(columns)),
+                                          chunks = (max(1, chunkRows), len(columns)),
+                                          dtype = 'int32')
+
+    def _append(self, ds, records):
+        start = ds.shape[0]
+        ds.resize((start + len(records), ds.shape[1]))
+        ds[start:] = records
+
+    def writeRecords(self, bestRecords, allRecords = None):
+        """Append rows to the best and, with extended info, all datasets"""
+        if len(bestRecords):
+            self._append(self.bestDS, bestRecords)
+        if self.writeExtendedInfo and allRecords is not None and len(allRecords):
+            self._append(self.allDS, allRecords)
+        self.h5File.flush()
+
+    def writeZmws(self, labeledZmws):
+        """Append the LabeledZmwTable of a chunk of ZMWs"""
+        if not len(labeledZmws):
+            return
+        self.writeRecords(labeledZmws.bestRecords(),
+                          labeledZmws.allRecords() if self.writeExtendedInfo else None)
+
+    def close(self):
+        self.h5File.close()
+
+def mergeBarcodeH5Files(inFiles, outFile, slabSize = 100000):
+    """Concatenate the bc.h5 files of consecutive hole-number ranges of a
+    movie, in order, into a single bc.h5 file, copying slabSize rows at a
+    time"""
+    inH5s = [h5.File(inFile, 'r') for inFile in inFiles]
+    try:
+        best = inH5s[0][BC_DS_PATH]
+        writeExtendedInfo = BC_DS_ALL_PATH in inH5s[0]
+        labeler = Bunch(movieName = best.attrs['movieName'],
+                        barcodeLabels = best.attrs['barcodes'],
+                        barcodeNames = inH5s[0][BC_DS_ALL_PATH].attrs['barcodes'] \
+                            if writeExtendedInfo else [],
+                        scoreMode = best.attrs['scoreMode'],
+                        stopMargin = best.attrs.get('stopMargin', 0))
+
+        with BarcodeH5Writer(outFile, labeler, writeExtendedInfo) as writer:
+            for inH5 in inH5s:
+                for i in xrange(0, len(inH5[BC_DS_PATH]), slabSize):
+                    writer.writeRecords(inH5[BC_DS_PATH][i:i + slabSize])
+                if writeExtendedInfo:
+                    for i in xrange(0, len(inH5[BC_DS_ALL_PATH]), slabSize):
+                        writer.writeRecords([], inH5[BC_DS_ALL_PATH][i:i + slabSize])
+    finally:
+        for inH5 in inH5s:
+            inH5.close()
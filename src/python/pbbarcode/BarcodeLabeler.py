@@ -28,196 +28,537 @@
 #################################################################################$$
 
 import logging
+import threading
 import numpy as np
 
+from collections import deque
+
+from multiprocessing.pool import ThreadPool
+
 from pbcore.io import BasH5Reader, BaxH5Reader
-from pbcore.io.BarcodeH5Reader import LabeledZmw
 from pbbarcode.SWaligner import SWaligner
-from pbbarcode.utils import makeBarcodeLabel, Bunch, reverseComplement
-
-def makeFromRangeFunc(barcodeLength, insertSidePad, adapterSidePad, useOldWorkflow):
+from pbbarcode.BarcodeSet import BarcodeSet
+from pbbarcode.KmerIndex import KmerIndex
+from pbbarcode.LabeledZmwTable import LabeledZmwTable, LABEL_DTYPE
+from pbbarcode.utils import Bunch, encodeSequence, reverseComplementCodes, prefetch
+
+def readFlank(zmw, start, end):
+    """Return the encoded basecalls of a ZMW between start and end, or None
+    if there are none"""
+    flank = encodeSequence(zmw.read(start, end).basecalls())
+    return flank if len(flank) else None
+
+def makeFromRangeFunc(barcodeLengths, insertSidePad, adapterSidePad, useOldWorkflow):
     """In order to score an Adapter for possible barcodes, we need a function that
     returns the ranges of sequence immediately to the 5' and 3' end of a given
-    adapter, which differ slightly between workflows."""
+    adapter, which differ slightly between workflows.  Barcodes of different
+    lengths need flanks of different lengths, so the function returns the
+    (left, right) flanks for each of barcodeLengths."""
 
     if useOldWorkflow:
         # The old fromRange function reports ranges in their default orientation
-        def fromRangeFunc(zmw, rStart, rEnd):
+        def flankPair(zmw, rStart, rEnd, barcodeLength):
             try:
-                qSeqLeft = zmw.read(rStart - (barcodeLength + insertSidePad),
-                                    rStart + adapterSidePad).basecalls()
+                qSeqLeft = readFlank(zmw, rStart - (barcodeLength + insertSidePad),
+                                     rStart + adapterSidePad)
             except IndexError:
                 qSeqLeft = None
             try:
-                qSeqRight = zmw.read(rEnd - adapterSidePad,
-                                     rEnd + barcodeLength + insertSidePad).basecalls()
+                qSeqRight = readFlank(zmw, rEnd - adapterSidePad,
+                                      rEnd + barcodeLength + insertSidePad)
             except IndexError:
                 qSeqRight = None
             return (qSeqLeft, qSeqRight)
     else:
         # The new fromRange function reports ranges oriented away from the Adapter
-        def fromRangeFunc(zmw, rStart, rEnd):
+        def flankPair(zmw, rStart, rEnd, barcodeLength):
             try:
-                qSeqLeftRaw = zmw.read(rStart - (barcodeLength + insertSidePad),
-                                       rStart + adapterSidePad).basecalls()
-                qSeqLeft = reverseComplement( qSeqLeftRaw )
+                qSeqLeftRaw = readFlank(zmw, rStart - (barcodeLength + insertSidePad),
+                                        rStart + adapterSidePad)
+                qSeqLeft = reverseComplementCodes( qSeqLeftRaw ) \
+                    if qSeqLeftRaw is not None else None
             except IndexError:
                 qSeqLeft = None
             try:
-                qSeqRight = zmw.read(rEnd - adapterSidePad,
-                                     rEnd + barcodeLength + insertSidePad).basecalls()
+                qSeqRight = readFlank(zmw, rEnd - adapterSidePad,
+                                      rEnd + barcodeLength + insertSidePad)
             except IndexError:
                 qSeqRight = None
             return (qSeqLeft, qSeqRight)
 
+    def fromRangeFunc(zmw, rStart, rEnd):
+        return tuple(flankPair(zmw, rStart, rEnd, barcodeLength)
+                     for barcodeLength in barcodeLengths)
+
     # Return the selected fromRange function
     return fromRangeFunc
 
-def makeScoreFlankingFunc(forwardScorer, reverseScorer, pairedScorer,
-                          scoreMode, numSeqs, oldWorkflow):
-    """Once the flanking regions around an adapter have been extracted
-    they need to be scored against the appropriate set of barcode sequences,
-    the specifics of which vary by scoreMode and workflow.
+def makeBulkFromRangeFunc(barcodeLengths, insertSidePad, adapterSidePad,
+                          useOldWorkflow, maxHits):
+    """Extracting the flanks one zmw.read() at a time goes through pbcore's
+    ZMW objects and an HDF5 read per flank, so instead return a function
+    that extracts the flanks of the first maxHits adapters of a set of holes
+    of a bax.h5 file (a pbcore BaxH5Reader) in bulk: their basecalls are read
+    as one contiguous slice of the BaseCalls dataset and the flanks sliced
+    out of it, at the offsets computed from the Regions table.  As with
+    pbcore, adapters are clipped to the HQ region, and flanks extending past
+    either end of a read are missing (None), as are empty ones.  Like
+    makeFromRangeFunc, each adapter gets the (left, right) flanks for each of
+    barcodeLengths, all sliced from the same read."""
+    indices = {}
+
+    def loadIndex(baxH5):
+        # The basecall offsets and regions of every hole, read once per file
+        if baxH5.file.filename not in indices:
+            baseCalls = baxH5.file["/PulseData/BaseCalls"]
+            regions = baxH5.file["/PulseData/Regions"]
+            numEvent = baseCalls["ZMW/NumEvent"][:].astype(int)
+            regionTypes = list(regions.attrs["RegionTypes"])
+            regionTable = regions[:].astype(int)
+            regionTable = regionTable[np.argsort(regionTable[:, 0], kind = 'mergesort')]
+            indices[baxH5.file.filename] = Bunch(
+                holeNumbers = baseCalls["ZMW/HoleNumber"][:].astype(int),
+                numEvent = numEvent,
+                offsets = np.cumsum(numEvent) - numEvent,
+                basecalls = baseCalls["Basecall"],
+                regions = regionTable,
+                adapterType = regionTypes.index("Adapter"),
+                hqType = regionTypes.index("HQRegion"))
+        return indices[baxH5.file.filename]
+
+    def bulkFromRangeFunc(baxH5, holeNumbers):
+        index = loadIndex(baxH5)
+        holeNumbers = np.asarray(holeNumbers, dtype = int)
+        flanking = [[] for _ in holeNumbers]
+        if not len(holeNumbers):
+            return flanking
+
+        # One contiguous read spanning the basecalls of all of the holes
+        rows = np.searchsorted(index.holeNumbers, holeNumbers)
+        numEvent = index.numEvent[rows]
+        first = index.offsets[rows].min()
+        basecalls = encodeSequence(index.basecalls[first:(index.offsets[rows] +
+                                                          numEvent).max()])
+        offsets = index.offsets[rows] - first
+        rcBasecalls = reverseComplementCodes(basecalls)
+
+        # The regions of the holes, and the HQ region of each of them
+        order = np.argsort(holeNumbers, kind = 'mergesort')
+        sortedHoles = holeNumbers[order]
+        regions = index.regions[np.searchsorted(index.regions[:, 0], sortedHoles[0]):
+                                np.searchsorted(index.regions[:, 0], sortedHoles[-1], 'right')]
+        regions = regions[np.in1d(regions[:, 0], sortedHoles)]
+        hqStart = np.zeros(len(holeNumbers), dtype = int)
+        hqEnd = np.zeros(len(holeNumbers), dtype = int)
+        hqRegions = regions[regions[:, 1] == index.hqType]
+        hqIdx = order[np.searchsorted(sortedHoles, hqRegions[:, 0])]
+        hqStart[hqIdx], hqEnd[hqIdx] = hqRegions[:, 2], hqRegions[:, 3]
+
+        # The first maxHits adapters of each hole, clipped to its HQ region
+        adapters = regions[regions[:, 1] == index.adapterType]
+        holeIdx = order[np.searchsorted(sortedHoles, adapters[:, 0])]
+        starts = np.maximum(adapters[:, 2], hqStart[holeIdx])
+        ends = np.minimum(adapters[:, 3], hqEnd[holeIdx])
+        clipped = starts < ends
+        holeIdx, starts, ends = holeIdx[clipped], starts[clipped], ends[clipped]
+        firstOfHole = np.concatenate(([True], holeIdx[1:] != holeIdx[:-1]))
+        groupStarts = np.flatnonzero(firstOfHole)
+        rank = np.arange(len(holeIdx)) - \
+            np.repeat(groupStarts, np.diff(np.append(groupStarts, len(holeIdx))))
+        kept = rank < maxHits
+        holeIdx, starts, ends = holeIdx[kept], starts[kept], ends[kept]
+
+        def flankPairs(barcodeLength):
+            # Flank coordinates within the reads and within the basecalls read
+            flankLen = barcodeLength + insertSidePad
+            leftStarts, leftEnds = starts - flankLen, starts + adapterSidePad
+            rightStarts, rightEnds = ends - adapterSidePad, ends + flankLen
+            leftValid = (leftStarts >= 0) & (leftStarts < leftEnds) & \
+                (leftEnds <= numEvent[holeIdx])
+            rightValid = (rightStarts >= 0) & (rightStarts < rightEnds) & \
+                (rightEnds <= numEvent[holeIdx])
+            leftStarts, leftEnds = leftStarts + offsets[holeIdx], leftEnds + offsets[holeIdx]
+            rightStarts, rightEnds = rightStarts + offsets[holeIdx], rightEnds + offsets[holeIdx]
+
+            pairs = []
+            for i in xrange(len(holeIdx)):
+                if not leftValid[i]:
+                    left = None
+                elif useOldWorkflow:
+                    left = basecalls[leftStarts[i]:leftEnds[i]]
+                else:
+                    # The new workflow reports the left flank oriented away
+                    #    from the adapter
+                    left = rcBasecalls[len(basecalls) - leftEnds[i]:
+                                       len(basecalls) - leftStarts[i]]
+                right = basecalls[rightStarts[i]:rightEnds[i]] if rightValid[i] else None
+                pairs.append((left, right))
+            return pairs
+
+        groupPairs = [flankPairs(barcodeLength) for barcodeLength in barcodeLengths]
+        for i, z in enumerate(holeIdx):
+            flanking[z].append(tuple(pairs[i] for pairs in groupPairs))
+        return flanking
+
+    return bulkFromRangeFunc
+
+def makeChunkScorer(batchScorer, numSeqs, maxScore, band = -1, kmerIndex = None,
+                    topK = 0, sampleEvery = 0):
+    """Scoring the flanks one ctypes call at a time is expensive, so we
+    instead score all of the flanks of a chunk of ZMWs in one batch call
+    ('prime') and let the scoreFlanking functions look up their rows.  Each
+    thread primes and reads its own chunk.
+
+    Two approximations may be used to save DP work: with a non-negative band,
+    each flank is aligned only around the diagonal it was primed with; with a
+    kmerIndex, only the topK barcodes sharing the most k-mers with a flank are
+    aligned to it and the others are given the index's lower bound.  Every
+    'sampleEvery'-th flank is then also given the full DP against every
+    barcode, and scorer.sampleStats counts how many of those sampled flanks
+    got a different best barcode score.
+
+    Flanks may also be primed with the floor each barcode has to score on
+    them (see makeAdapterFloorFunc), in which case the aligner gives up on a
+    barcode once it cannot reach it and barcodes with a floor above maxScore
+    are not aligned at all."""
+    chunk = threading.local()
+    prefilter = kmerIndex is not None and topK < numSeqs
+    approximate = band >= 0 or prefilter
+    sampleStats = Bunch(sampled = 0, differ = 0)
+    sampleStatsLock = threading.Lock()
+
+    def prime(queries, diagonals, floors = None):
+        # A flank seen at two different offsets gets the full DP, and one
+        #    seen with two different floors the lower of them
+        if floors is None:
+            floors = [None] * len(queries)
+        flankSeqs, flankDiagonals, flankFloors = {}, {}, {}
+        for query, diagonal, floor in zip(queries, diagonals, floors):
+            if query is not None:
+                key = query.tostring()
+                flankSeqs[key] = query
+                flankDiagonals[key] = diagonal if \
+                    flankDiagonals.get(key, diagonal) == diagonal else None
+                if key not in flankFloors:
+                    flankFloors[key] = floor
+                elif floor is None or flankFloors[key] is None:
+                    flankFloors[key] = None
+                else:
+                    flankFloors[key] = np.minimum(floor, flankFloors[key])
+        keys      = flankSeqs.keys()
+        queries   = [flankSeqs[key] for key in keys]
+        diagonals = [flankDiagonals[key] for key in keys]
+        floors    = [flankFloors[key] for key in keys]
+        pruned    = [floor is not None for floor in floors]
+
+        if prefilter:
+            candidates, scores = kmerIndex.shortlist(queries, topK)
+        elif any(pruned):
+            candidates = np.tile(np.arange(numSeqs, dtype = np.int32), (len(queries), 1))
+            scores = np.zeros((len(queries), numSeqs), dtype = np.int32)
+        else:
+            candidates, scores = None, None
+
+        candidateFloors = None
+        if any(pruned):
+            candidateFloors = np.array([floor if floor is not None else
+                                        np.zeros(numSeqs, dtype = int)
+                                        for floor in floors])
+            candidateFloors = candidateFloors[np.arange(len(queries))[:, None], candidates]
+            candidates[candidateFloors > maxScore] = -1
+
+        scores = batchScorer(queries, out = scores, diagonals = diagonals, band = band,
+                             candidates = candidates, floors = candidateFloors)
+        chunk.index  = dict(zip(keys, xrange(len(keys))))
+        chunk.scores = scores
+
+        # Pruned flanks are only exact for the barcodes reaching their floors
+        if approximate and sampleEvery > 0 and queries:
+            sampled = [i for i in xrange(0, len(queries), sampleEvery) if not pruned[i]]
+            if sampled:
+                fullScores = batchScorer([queries[i] for i in sampled])
+                differ = fullScores.max(1) != scores[sampled].max(1)
+                with sampleStatsLock:
+                    sampleStats.sampled += len(differ)
+                    sampleStats.differ  += int(differ.sum())
+
+    def scoreAll(queries):
+        # Look up the rows of the primed flanks, and align any other ones
+        scores = np.zeros((len(queries), numSeqs), dtype = np.int32)
+        index = getattr(chunk, 'index', {})
+        rows = [index.get(query.tostring()) if query is not None else None
+                for query in queries]
+        primed = [i for i, row in enumerate(rows) if row is not None]
+        if primed:
+            scores[primed] = chunk.scores[[rows[i] for i in primed]]
+        unprimed = [i for i, row in enumerate(rows)
+                    if row is None and queries[i] is not None]
+        if unprimed:
+            scores[unprimed] = batchScorer([queries[i] for i in unprimed])
+        return scores
+
+    def scorer(query):
+        return scoreAll([query])[0]
+
+    scorer.scoreAll = scoreAll
+    scorer.prime = prime
+    scorer.approximate = approximate
+    scorer.sampleStats = sampleStats
+    return scorer
+
+def makeBidirectionalScorer(chunkScorer, numSeqs):
+    """The old workflow scores every flank against both the forward and the
+    reverse-complemented barcodes.  Given a chunk scorer over the forward
+    barcodes followed by the reverse ones, which aligns each flank to both
+    in the same sweep, return a scorer splitting its scores into a
+    (forward, reverse) pair."""
+    def scoreAll(queries):
+        scores = chunkScorer.scoreAll(queries)
+        return (scores[:, :numSeqs], scores[:, numSeqs:])
+
+    def scorer(query):
+        scores = chunkScorer(query)
+        return (scores[:numSeqs], scores[numSeqs:])
+
+    def prime(queries, diagonals, floors = None):
+        # A barcode's floor applies to it in either orientation
+        if floors is not None:
+            floors = [np.tile(floor, 2) if floor is not None else None
+                      for floor in floors]
+        chunkScorer.prime(queries, diagonals, floors)
+
+    scorer.scoreAll = scoreAll
+    scorer.prime = prime
+    scorer.approximate = chunkScorer.approximate
+    scorer.sampleStats = chunkScorer.sampleStats
+    return scorer
+
+def makeScoreAdaptersFunc(forwardScorer, bidirectionalScorer, pairedScorer,
+                          scoreMode, oldWorkflow):
+    """Once the flanking regions around the adapters of a chunk of ZMWs have
+    been extracted they need to be scored against the appropriate set of
+    barcode sequences, the specifics of which vary by scoreMode and workflow.
+    Return a function giving the (nAdapters, numSeqs) scores of a list of
+    (left, right) flanks against the barcodes of the scorers.
     """
 
-    def scoreFlankingOld(holeNum, adapters, scoredFirst):
-        adapterScores = [[]]*len(adapters)
-        barcodeScores = np.zeros(numSeqs)
-        for i, adapter in enumerate(adapters):
-            fscores  = forwardScorer(adapter[0])
-            rscores  = reverseScorer(adapter[0])
-            ffscores = forwardScorer(adapter[1])
-            rrscores = reverseScorer(adapter[1])
-
-            # Average the two flanking scores for the adapter score
-            if adapter[0] and adapter[1]:
-                adapterScores[i] = np.maximum((fscores + rrscores)/2.0,
-                                             (rscores + ffscores)/2.0)
-            # Single flanking scores are taken as-is
-            elif adapter[0] or adapter[1]:
-                adapterScores[i] = np.maximum((fscores + rrscores),
-                                             (rscores + ffscores))
-            # Otherwise return the empty
-            else:
-                adapterScores[i] = barcodeScores
-
-        barcodeScores = reduce(lambda x, y: x + y, adapterScores) if adapterScores \
-            else barcodeScores
-
-        return Bunch(holeNum=holeNum, numAdapters=len(adapters),
-                     barcodeScores=barcodeScores, adapterScores=adapterScores,
-                     scoredFirst=scoredFirst)
-
-    def scoreFlankingPaired(holeNum, adapters, scoredFirst):
-        adapterScores = [[]]*len(adapters)
-        barcodeScores = np.zeros(numSeqs)
-        for i, adapter in enumerate(adapters):
-            fscores = pairedScorer(adapter[0])
-            rscores = pairedScorer(adapter[1])
-
-            # Average the two flanking scores for the adapter score
-            if adapter[0] and adapter[1]:
-                adapterScores[i] = (fscores + rscores)/2.0
-            # Single flanking scores are taken as-is
-            elif adapter[0] or adapter[1]:
-                adapterScores[i] = (fscores + rscores)
-            # Otherwise return the empty
-            else:
-                adapterScores[i] = barcodeScores
-
-        barcodeScores = reduce(lambda x, y: x + y, adapterScores) if adapterScores \
-            else barcodeScores
-
-        return Bunch(holeNum=holeNum, numAdapters=len(adapters),
-                     barcodeScores=barcodeScores, adapterScores=adapterScores,
-                     scoredFirst=scoredFirst)
-
-    def scoreFlankingSymmetric(holeNum, adapters, scoredFirst):
-        adapterScores = [[]]*len(adapters)
-        barcodeScores = np.zeros(numSeqs)
-        for i, adapter in enumerate(adapters):
-            fscores = forwardScorer(adapter[0])
-            rscores = forwardScorer(adapter[1])
-
-            # Average the two flanking scores for the adapter score
-            if adapter[0] and adapter[1]:
-                adapterScores[i] = (fscores + rscores)/2.0
-            # Single flanking scores are taken as-is
-            elif adapter[0] or adapter[1]:
-                adapterScores[i] = (fscores + rscores)
-            # Otherwise return the empty
-            else:
-                adapterScores[i] = barcodeScores
-
-        barcodeScores = reduce(lambda x, y: x + y, adapterScores) if adapterScores \
-            else barcodeScores
+    # Each returns the (nAdapters, numSeqs) sums of the flank scores
+    def sumFlanksOld(lefts, rights):
+        fscores, rscores   = bidirectionalScorer.scoreAll(lefts)
+        ffscores, rrscores = bidirectionalScorer.scoreAll(rights)
+        return np.maximum(fscores + rrscores, rscores + ffscores)
 
-        return Bunch(holeNum=holeNum, numAdapters=len(adapters),
-                     barcodeScores=barcodeScores, adapterScores=adapterScores,
-                     scoredFirst=scoredFirst)
+    def makeSumFlanksNew(scorer):
+        def sumFlanksNew(lefts, rights):
+            return scorer.scoreAll(lefts) + scorer.scoreAll(rights)
+        return sumFlanksNew
 
-    # Return the workflow/scoreMode appropriate scoring function
+    # Select the workflow/scoreMode appropriate flank scoring function
     if oldWorkflow:
-        return scoreFlankingOld
-    elif scoreMode == 'paired' and not oldWorkflow:
-        return scoreFlankingPaired
-    elif scoreMode == 'symmetric' and not oldWorkflow:
-        return scoreFlankingSymmetric
-
-# The following two functs create labeledZmws from a scoreBunch object
-def makeSymmetricZmw(scoreBunch):
-    """Convert a dictionary-like object with barcode scoring information
-    into a LabeledZmw for a symmetrically barcoded read"""
-    rankedBarcodes = np.argsort(-1 * scoreBunch.barcodeScores)
-    bestIdx = rankedBarcodes[0]
-    secondBestIdx = rankedBarcodes[1]
-    return LabeledZmw(scoreBunch.holeNum,
-                      scoreBunch.numAdapters,
-                      bestIdx,
-                      scoreBunch.barcodeScores[bestIdx],
-                      secondBestIdx,
-                      scoreBunch.barcodeScores[secondBestIdx],
-                      scoreBunch.adapterScores)
-
-def makePairedZmw(scoreBunch):
-    """Convert a dictionary-like object with barcode scoring information
-    into a LabeledZmw for a symmetrically barcoded read"""
-    numSeqs = len(scoreBunch.barcodeScores)
-    if scoreBunch.numAdapters == 1:
-        # If we have one adapter, pick the best barcode from each pair as the
-        #    score for that pair
-        rawPairScores = [max(scoreBunch.barcodeScores[i], scoreBunch.barcodeScores[i+1]) \
-                         for i in xrange(0, numSeqs, 2)]
-        pairScores = np.array(rawPairScores)
-        barcodeRanks = np.argsort(-pairScores)
-        pairScores = pairScores[barcodeRanks]
+        sumFlanks = sumFlanksOld
+    elif scoreMode == 'paired':
+        sumFlanks = makeSumFlanksNew(pairedScorer)
+    elif scoreMode == 'symmetric':
+        sumFlanks = makeSumFlanksNew(forwardScorer)
+
+    def scoreAdapters(adapters):
+        lefts  = [left for left, _ in adapters]
+        rights = [right for _, right in adapters]
+        # Average the two flanking scores for the adapter score, single
+        #    flanking scores are taken as-is and missing ones are 0
+        bothFlanks = np.array([left is not None and right is not None
+                               for left, right in adapters], dtype = bool)
+        scores = sumFlanks(lefts, rights).astype(float)
+        scores[bothFlanks] /= 2.0
+        return scores
+
+    return scoreAdapters
+
+def makeScoreFlankingFunc(groups, numSeqs):
+    """Barcodes of different lengths are scored in groups of the same length,
+    each against the flanks extracted for its length by its own scoreAdapters
+    function (see makeScoreAdaptersFunc).  Return a function merging the
+    scores of the groups into the columns of their barcodes, for adapters
+    holding the (left, right) flanks of every group in turn.  The scores of a
+    list of adapters are also available as scoreFlanking.scoreAdapters."""
+    def scoreAdapters(adapters):
+        scores = np.zeros((len(adapters), numSeqs))
+        for g, group in enumerate(groups):
+            scores[:, group.idxs] = group.scoreAdapters([adapter[g] for adapter in adapters])
+        return scores
+
+    def scoreFlanking(holeNums, flanking):
+        """Given the (adapters, scoredFirst) flanks of a chunk of ZMWs, return
+        their (nZmws, maxAdapters, numSeqs) adapter scores, zero-padded past
+        each ZMW's numAdapters, and their (nZmws, numSeqs) barcode scores"""
+        numAdapters = np.array([len(adapters) for adapters, _ in flanking], dtype = int)
+        adapterScores = np.zeros((len(flanking), numAdapters.max() if len(flanking) else 0,
+                                  numSeqs))
+        zmwIdx = np.repeat(np.arange(len(flanking)), numAdapters)
+        adapterIdx = np.arange(len(zmwIdx)) - np.repeat(np.cumsum(numAdapters) - numAdapters,
+                                                        numAdapters)
+        adapterScores[zmwIdx, adapterIdx] = \
+            scoreAdapters([adapter for adapters, _ in flanking for adapter in adapters])
+
+        return Bunch(holeNums=list(holeNums), numAdapters=numAdapters,
+                     barcodeScores=adapterScores.sum(1), adapterScores=adapterScores,
+                     scoredFirst=np.array([scoredFirst for _, scoredFirst in flanking],
+                                          dtype = bool))
+
+    scoreFlanking.scoreAdapters = scoreAdapters
+    return scoreFlanking
+
+def makeAdapterFloorFunc(scoreMode, numSeqs, maxScore):
+    """makeSymmetricZmw and makePairedZmw only report the best two barcodes
+    (or pairs) of a ZMW, whose scores are sums of adapter scores of at most
+    maxScore each (an array with the maximum of each barcode).  When the
+    adapters are scored one at a time, the second best sum of the adapters
+    scored so far is a lower bound of the final second best, so any barcode
+    which cannot reach it on the next adapter may be given any score up to
+    maxScore there without changing the result.
+
+    Return a function which, given the (nZmws, i, numSeqs) scores of the
+    first i adapters of a set of ZMWs with numAdapters adapters each, returns
+    the (nZmws, numSeqs) scores each barcode has to reach on adapter i to keep
+    its barcode (pair) in the running."""
+
+    def floorSymmetric(scores, numAdapters):
+        i = scores.shape[1]
+        if numSeqs < 2:
+            return np.zeros((len(scores), numSeqs))
+        scored = scores.sum(1)
+        secondBest = np.partition(scored, -2, axis = 1)[:, -2]
+        return secondBest[:, None] - scored - \
+            maxScore * (numAdapters - i - 1)[:, None]
+
+    def floorPaired(scores, numAdapters):
+        i = scores.shape[1]
+        if numSeqs < 4:
+            return np.zeros((len(scores), numSeqs))
+        # As in makePairedZmw, adapter j of barcode k counts towards the
+        #    (j + k) % 2 orientation of its pair
+        scored = [scores[:, p::2].sum(1) for p in (0, 1)]
+        orientations = np.maximum(scored[0][:, 0::2] + scored[1][:, 1::2],
+                                  scored[1][:, 0::2] + scored[0][:, 1::2])
+        secondBest = np.partition(orientations, -2, axis = 1)[:, -2]
+
+        # The other adapters of adapter i's orientation: those scored, and
+        #    at most maxScore for each of the ones after i
+        unscored = [(numAdapters + 1 - p) // 2 - (i + 2 - p) // 2 for p in (0, 1)]
+        upper = [scored[p] + maxScore * unscored[p][:, None] for p in (0, 1)]
+        partner = np.arange(numSeqs) ^ 1
+        return secondBest[:, None] - (upper[i % 2] + upper[1 - i % 2][:, partner])
+
+    if scoreMode == 'paired':
+        return floorPaired
+    else:
+        return floorSymmetric
+
+def makeLabeledZmwTable(scoreBunch, scores):
+    """Rank the (nZmws, n) barcode (or pair) scores of a chunk of ZMWs and
+    return a LabeledZmwTable of the best two of each ZMW with adapters"""
+    labeled = scoreBunch.numAdapters > 0
+    scores = scores[labeled]
+    rankedBarcodes = np.argsort(-1 * scores, axis = 1)
+    rows = np.arange(len(scores))
+
+    records = np.zeros(len(scores), dtype = LABEL_DTYPE)
+    records['holeNumber'] = np.asarray(scoreBunch.holeNums, dtype = int)[labeled]
+    records['nAdapters'] = scoreBunch.numAdapters[labeled]
+    records['bestIdx'] = rankedBarcodes[:, 0]
+    records['bestScore'] = scores[rows, rankedBarcodes[:, 0]]
+    records['secondBestIdx'] = rankedBarcodes[:, 1]
+    records['secondBestScore'] = scores[rows, rankedBarcodes[:, 1]]
+
+    # The scored adapters of each ZMW, in order, without the padding
+    adapterScores = scoreBunch.adapterScores
+    scored = np.arange(adapterScores.shape[1]) < scoreBunch.numAdapters[:, None]
+    return LabeledZmwTable(records, adapterScores[scored])
+
+# The following two functs create the LabeledZmwTable of the ZMWs with
+#    adapters from the scoreBunch of a chunk
+def makeSymmetricZmws(scoreBunch):
+    """Convert a dictionary-like object with the barcode scores of a chunk
+    of ZMWs into labels for symmetrically barcoded reads"""
+    return makeLabeledZmwTable(scoreBunch, scoreBunch.barcodeScores)
+
+def pairScores(barcodeScores, adapterScores, numAdapters):
+    """Return the (nZmws, numSeqs / 2) scores of the barcode pairs of a chunk
+    of ZMWs, given their barcode and (zero-padded) adapter scores"""
+    # If we have one adapter, pick the best barcode from each pair as the
+    #    score for that pair
+    singleScores = np.maximum(barcodeScores[:, 0::2], barcodeScores[:, 1::2])
+
+    # If we have more than one adapter, score the two possible orderings we
+    #    expect (F--R--F... or R--F--R...) then take the best score from
+    #    those two possibilities as the score for that pair: the even
+    #    adapters count towards the first barcode of a pair in one ordering
+    #    and towards the second in the other, and vice versa for the odd ones
+    # NOTE: A missed adapter will confuse this computation.
+    evenScores = adapterScores[:, 0::2].sum(1)
+    oddScores  = adapterScores[:, 1::2].sum(1)
+    pairedScores = np.maximum(evenScores[:, 0::2] + oddScores[:, 1::2],
+                              oddScores[:, 0::2] + evenScores[:, 1::2])
+
+    return np.where((numAdapters == 1)[:, None], singleScores, pairedScores)
+
+def makePairedZmws(scoreBunch):
+    """Convert a dictionary-like object with the barcode scores of a chunk
+    of ZMWs into labels for reads barcoded with pairs"""
+    return makeLabeledZmwTable(scoreBunch,
+                               pairScores(scoreBunch.barcodeScores,
+                                          scoreBunch.adapterScores,
+                                          scoreBunch.numAdapters))
+
+def makeLabelMarginFunc(scoreMode):
+    """Return a function which, given the (nZmws, i, numSeqs) scores of the
+    first i adapters of a set of ZMWs, returns by how much the best barcode
+    (or pair) of each ZMW leads its second best, as makeSymmetricZmws and
+    makePairedZmws would rank them after those i adapters"""
+    def margin(scores):
+        if scores.shape[1] < 2:
+            return np.inf * np.ones(len(scores))
+        best = np.partition(scores, -2, axis = 1)[:, -2:]
+        return best[:, 1] - best[:, 0]
+
+    def marginSymmetric(scores):
+        return margin(scores.sum(1))
+
+    def marginPaired(scores):
+        return margin(pairScores(scores.sum(1), scores,
+                                 np.repeat(scores.shape[1], len(scores))))
+
+    if scoreMode == 'paired':
+        return marginPaired
     else:
-        # If we have more than one adapter, score the two possible orderings we
-        #    expec (F--R--F... or R--F--R...) then take the best score from
-        #    those two possibilities as the score for that pair.
-        # NOTE: A missed adapter will confuse this computation.
-        scores  = scoreBunch.adapterScores
-        results = np.zeros(numSeqs/2)
-        for i in xrange(0, numSeqs, 2):
-            orientations = [0,0]
-            for j in xrange(0, len(scores)):
-                orientations[j % 2] += scores[j][i]
-                orientations[1 - j % 2] += scores[j][i + 1]
-            results[i/2] = max(orientations)
-        barcodeRanks = np.argsort(-results)
-        pairScores = results[barcodeRanks]
-
-    bestIdx = barcodeRanks[0]
-    bestScore = pairScores[0]
-    secondBestIdx = barcodeRanks[1]
-    secondBestScore = pairScores[1]
-    return LabeledZmw(scoreBunch.holeNum,
-                      scoreBunch.numAdapters,
-                      bestIdx,
-                      bestScore,
-                      secondBestIdx,
-                      secondBestScore,
-                      scoreBunch.adapterScores)
+        return marginSymmetric
+
+def makeTiedAtTopFunc(scoreMode):
+    """Return a function which, given the barcode and (zero-padded) adapter
+    scores and numAdapters of a chunk of ZMWs, flags those whose best two
+    barcodes (or pairs) tie with each other or with the third best.  The
+    argsort of makeLabeledZmwTable is not stable, so how it ranks such ties
+    depends on every score of the ZMW, not only on the best two"""
+    def tiedAtTop(scores):
+        if scores.shape[1] < 2:
+            return np.zeros(len(scores), dtype = bool)
+        top = min(3, scores.shape[1])
+        best = np.sort(np.partition(-scores, top - 1, axis = 1)[:, :top], axis = 1)
+        tied = best[:, 0] == best[:, 1]
+        if top == 3:
+            tied |= best[:, 1] == best[:, 2]
+        return tied
+
+    def tiedSymmetric(barcodeScores, adapterScores, numAdapters):
+        return tiedAtTop(barcodeScores)
+
+    def tiedPaired(barcodeScores, adapterScores, numAdapters):
+        return tiedAtTop(pairScores(barcodeScores, adapterScores, numAdapters))
+
+    if scoreMode == 'paired':
+        return tiedPaired
+    else:
+        return tiedSymmetric
 
 
 class BarcodeScorer(object):
@@ -234,95 +575,179 @@ class BarcodeScorer(object):
                  maxHits = 10,
                  scoreFirst = False,
                  startTimeCutoff = 1,
-                 useOldWorkflow = False):
+                 useOldWorkflow = False,
+                 chunkSize = 1000,
+                 nThreads = 1,
+                 band = -1,
+                 kmerSize = 5,
+                 kmerTopK = 0,
+                 prune = False,
+                 sampleEvery = 100,
+                 stopMargin = 0,
+                 prefetch = 0):
 
         self.basH5           = basH5
-        self.barcodeFasta    = list(barcodeFasta)
-        self.numSeqs         = len(self.barcodeFasta)
-        self.barcodeNames    = np.array([x.name for x in self.barcodeFasta])
+        # The barcodes are either FASTA records, encoded here, or an already
+        #    compiled (and likely memory-mapped) BarcodeSet
+        if isinstance(barcodeFasta, BarcodeSet):
+            self.barcodeSet  = barcodeFasta
+        else:
+            self.barcodeSet  = BarcodeSet.fromFasta(barcodeFasta)
+        self.numSeqs         = len(self.barcodeSet)
+        self.barcodeNames    = np.array(self.barcodeSet.names)
         self.aligner         = SWaligner(useOldWorkflow)
+        # Only the barcode-set kernels band, prefilter and prune; the per-target
+        #    DP of a library without them fills every cell of every barcode
+        if not self.aligner.hasBarcodeSets and (band >= 0 or kmerTopK > 0 or prune):
+            logging.warn(("%s has no barcode-set kernels, ignoring band: %d, " + \
+                              "kmerTopK: %d and prune: %r") \
+                             % (self.aligner.SW_DLL_PATH, band, kmerTopK, prune))
+            band, kmerTopK, prune = -1, 0, False
         self.useOldWorkflow  = useOldWorkflow
         self.adapterSidePad  = adapterSidePad
         self.insertSidePad   = insertSidePad
         self.maxHits         = maxHits
         self.scoreFirst      = scoreFirst
         self.startTimeCutoff = startTimeCutoff
+        self.chunkSize       = chunkSize
+        self.nThreads        = nThreads
+        self.band            = band
+        self.kmerTopK        = kmerTopK
+        self.prune           = prune
+        self.stopMargin      = stopMargin
+        self.prefetch        = prefetch
+        # pbcore's readers are not thread-safe, only the alignment is shared
+        self._readLock       = threading.Lock()
 
         if scoreMode not in ['symmetric', 'paired']:
             raise Exception("scoreMode must either be symmetric or paired")
         self.scoreMode = scoreMode
 
-        barcodeLengths = np.unique(map(lambda x : len(x.sequence),
-                                       self.barcodeFasta))
-        if len(barcodeLengths) > 1:
-            raise Exception("Currently, all barcodes must be the same length.")
-        else:
-            self.barcodeLength = int(barcodeLengths)
-
-        # Original barcode sequences and scorers for the Old Workflow
-        self.barcodeSeqs = [(barcode.sequence.upper(),
-                             reverseComplement(barcode.sequence.upper()))
-                            for barcode in self.barcodeFasta]
-        forwardScorer = self.aligner.makeScorer([x[0] for x in self.barcodeSeqs])
-        reverseScorer = self.aligner.makeScorer([x[1] for x in self.barcodeSeqs])
-
+        # Barcodes of different lengths are scored in groups of one length,
+        #    each with flanks of its own length; an adapter scores at most
+        #    twice the length of a barcode
+        self.barcodeLengths = self.barcodeSet.lengths.astype(int)
+        self.maxScores = 2 * self.barcodeLengths
+        groupLengths = list(np.unique(self.barcodeLengths))
+
+        # Original barcode sequences and scorers for the Old Workflow, views
+        #    of the encoded sequences of the BarcodeSet
+        self.barcodeSeqs = [(self.barcodeSet.forward(i), self.barcodeSet.reverse(i))
+                            for i in xrange(0, self.numSeqs)]
         # Forward-oriented barcode sequence pairs for the New Workflow
-        self.orientedSeqs  = [bc.sequence.upper() if (i%2) == 0 else
-                              reverseComplement(bc.sequence.upper())
-                              for i, bc in enumerate(self.barcodeFasta)]
-        pairedScorer  = self.aligner.makeScorer( self.orientedSeqs )
+        self.orientedSeqs  = [self.barcodeSet.oriented(i)
+                              for i in xrange(0, self.numSeqs)]
+
+        def makeScorer(seqs, barcodeLength, topK = kmerTopK):
+            # With kmerTopK, each set of sequences gets its own k-mer index
+            kmerIndex = KmerIndex(seqs, kmerSize) if topK > 0 else None
+            return makeChunkScorer(self.aligner.makeBatchScorer(seqs), len(seqs),
+                                   2 * barcodeLength, band, kmerIndex, topK,
+                                   sampleEvery)
+
+        def makeGroup(barcodeLength):
+            idxs = np.flatnonzero(self.barcodeLengths == barcodeLength)
+            forwardScorer = makeScorer([self.barcodeSeqs[i][0] for i in idxs],
+                                       barcodeLength)
+            # Both orientations share one barcode set, and so one pass per flank
+            bidirectionalScorer = makeBidirectionalScorer(
+                makeScorer([self.barcodeSeqs[i][0] for i in idxs] +
+                           [self.barcodeSeqs[i][1] for i in idxs],
+                           barcodeLength, 2 * kmerTopK),
+                len(idxs))
+            pairedScorer = makeScorer([self.orientedSeqs[i] for i in idxs],
+                                      barcodeLength)
+
+            # Only prime the scorers that the scoreAdapters function will use
+            if self.useOldWorkflow:
+                chunkScorers = [bidirectionalScorer]
+            elif self.scoreMode == 'paired':
+                chunkScorers = [pairedScorer]
+            else:
+                chunkScorers = [forwardScorer]
+
+            return Bunch(barcodeLength = barcodeLength, idxs = idxs,
+                         chunkScorers = chunkScorers,
+                         scoreAdapters = makeScoreAdaptersFunc(forwardScorer,
+                                                               bidirectionalScorer,
+                                                               pairedScorer,
+                                                               self.scoreMode,
+                                                               self.useOldWorkflow))
+        self.barcodeGroups = [makeGroup(length) for length in groupLengths]
+        self.chunkScorers  = [scorer for group in self.barcodeGroups
+                              for scorer in group.chunkScorers]
+        # The group of each barcode
+        self.barcodeGroupIdx = np.searchsorted(groupLengths, self.barcodeLengths)
 
         # Given the scoreMode, create all of the possible barcode labels
-        if self.scoreMode == 'paired':
-            self.barcodeLabels = np.array([makeBarcodeLabel(self.barcodeFasta[i].name,
-                                           self.barcodeFasta[i+1].name)
-                                           for i in xrange(0, len(self.barcodeSeqs), 2)])
-        else:
-            self.barcodeLabels = np.array([makeBarcodeLabel(x.name, x.name)
-                                           for x in self.barcodeFasta])
+        self.barcodeLabels = self.barcodeSet.labels(self.scoreMode)
 
-        # Make a "fromRange" function for finding adapter-flanking regions
-        self.fromRange = makeFromRangeFunc(self.barcodeLength,
+        # Make a "fromRange" function for finding adapter-flanking regions,
+        #    and one extracting them from a whole chunk of a bax.h5 at once,
+        #    both of which return the flanks of each group
+        self.fromRange = makeFromRangeFunc(groupLengths,
                                            self.insertSidePad,
                                            self.adapterSidePad,
                                            self.useOldWorkflow)
+        self.bulkFromRange = makeBulkFromRangeFunc(groupLengths,
+                                                   self.insertSidePad,
+                                                   self.adapterSidePad,
+                                                   self.useOldWorkflow,
+                                                   self.maxHits)
+
+        # The barcode is expected to start this many bases into the left and
+        #    right flanks, which is where banded alignment centers its band;
+        #    the old workflow reports the left flank in its original orientation
+        self.flankDiagonals = (self.insertSidePad if self.useOldWorkflow else self.adapterSidePad,
+                               self.adapterSidePad)
 
         # Make a "scoreFlankingRegions" function for the results of "fromRange"
-        self.scoreFlankingRegions = makeScoreFlankingFunc(forwardScorer,
-                                                          reverseScorer,
-                                                          pairedScorer,
-                                                          self.scoreMode,
-                                                          self.numSeqs,
-                                                          self.useOldWorkflow)
+        self.scoreFlankingRegions = makeScoreFlankingFunc(self.barcodeGroups,
+                                                          self.numSeqs)
+
+        # With pruning, the floor each barcode has to score on an adapter
+        self.adapterFloor = makeAdapterFloorFunc(self.scoreMode, self.numSeqs,
+                                                 self.maxScores)
+        self.tiedAtTop = makeTiedAtTopFunc(self.scoreMode)
+
+        # With a stopMargin, the lead of the best barcode once the adapters
+        #    scored so far settle it, and how many adapters that saved
+        self.labelMargin = makeLabelMarginFunc(self.scoreMode)
+        self.adapterStats = Bunch(found = 0, scored = 0)
+        self._adapterStatsLock = threading.Lock()
 
         # Select the score-mode appropriate function for formatting scoring
         #    results into LabeledZmw objects
         if self.scoreMode == 'paired':
-            self.makeLabeledZmw = makePairedZmw
+            self.makeLabeledZmws = makePairedZmws
         else:
-            self.makeLabeledZmw = makeSymmetricZmw
+            self.makeLabeledZmws = makeSymmetricZmws
 
         # If initialization made it this far, log the settings used
         logging.debug(("Constructed BarcodeScorer with scoreMode: %s," + \
-                "adapterSidePad: %d, insertSidePad: %d, scoreFirst: %r, and oldWorkflow: %s") \
-                % (scoreMode, adapterSidePad, insertSidePad, scoreFirst, useOldWorkflow))
+                "adapterSidePad: %d, insertSidePad: %d, scoreFirst: %r, oldWorkflow: %s, " + \
+                "nThreads: %d, band: %d, kmerTopK: %d, prune: %r, and stopMargin: %g") \
+                % (scoreMode, adapterSidePad, insertSidePad, scoreFirst, useOldWorkflow,
+                   nThreads, band, kmerTopK, prune, stopMargin))
 
     @property
     def movieName(self):
         return self.basH5.movieName
 
-    def _flankingSeqs(self, zmw):
+    def _flankingSeqs(self, zmw, seqs = None):
         """Extract the flanking sequences for the first 'maxHits' adapters from a
-        ZMW.  If that number is 0 and scoreFirst is true, try to extract a barcode
-        from the 5' tip of the read instead.
+        ZMW, unless they were already extracted in bulk (seqs).  If that number
+        is 0 and scoreFirst is true, try to extract a barcode from the 5' tip of
+        the read instead.
         """
-        # Extract the first X adapters
-        adapterRegions = zmw.adapterRegions
-        if len(adapterRegions) > self.maxHits:
-            adapterRegions = adapterRegions[0:self.maxHits]
+        if seqs is None:
+            # Extract the first X adapters
+            adapterRegions = zmw.adapterRegions
+            if len(adapterRegions) > self.maxHits:
+                adapterRegions = adapterRegions[0:self.maxHits]
 
-        # Extract the (left, right) sequence pairs around each adapter
-        seqs = [self.fromRange(zmw, start, end) for (start, end) in adapterRegions]
+            # Extract the (left, right) sequence pairs around each adapter
+            seqs = [self.fromRange(zmw, start, end) for (start, end) in adapterRegions]
 
         # We only score the first barcode if we don't find any adapters
         # *and* the start time is less than the threshold.
@@ -332,23 +757,209 @@ class BarcodeScorer(object):
             e = zmw.zmwMetric('HQRegionEndTime')
             # s<e => has HQ.
             if s < e and s <= self.startTimeCutoff:
-                l = self.barcodeLength + self.insertSidePad
+                # One read covers the first barcode of every group
+                l = max(group.barcodeLength for group in self.barcodeGroups) + \
+                    self.insertSidePad
                 l = l if zmw.hqRegion[1] > l else zmw.hqRegion[1]
                 try:
-                    bc = zmw.read(0, l).basecalls()
-                    if len(bc) >= self.barcodeLength:
-                        seqs.insert(0, (bc, None))
-                        scoredFirst = True
+                    bc = readFlank(zmw, 0, l)
+                    if bc is not None:
+                        first = tuple((bc[:group.barcodeLength + self.insertSidePad], None)
+                                      if len(bc) >= group.barcodeLength else (None, None)
+                                      for group in self.barcodeGroups)
+                        if any(left is not None for left, _ in first):
+                            seqs.insert(0, first)
+                            scoredFirst = True
                 except IndexError:
                     pass
 
         return (seqs, scoredFirst)
 
-    def scoreZmw(self, zmw):
-        flankingRegions, scoredFirst = self._flankingSeqs(zmw)
-        return self.scoreFlankingRegions(zmw.holeNumber, flankingRegions, scoredFirst)
+    def _chunkFlankingSeqs(self, zmws):
+        """Extract the flanking sequences of a chunk of ZMWs, in bulk for each
+        bax.h5 file they come from; ZMWs from readers without the underlying
+        file are extracted one at a time"""
+        seqs = [None] * len(zmws)
+        parts = {}
+        for z, zmw in enumerate(zmws):
+            baxH5 = getattr(zmw, 'baxH5', None)
+            if getattr(baxH5, 'file', None) is not None:
+                parts.setdefault(baxH5.file.filename, (baxH5, []))[1].append(z)
+        for baxH5, idxs in parts.values():
+            extracted = self.bulkFromRange(baxH5, [zmws[z].holeNumber for z in idxs])
+            for z, adapters in zip(idxs, extracted):
+                seqs[z] = adapters
+        return [self._flankingSeqs(zmw, adapters) for zmw, adapters in zip(zmws, seqs)]
+
+    def scoreZmws(self, zmws):
+        """Score a chunk of ZMWs, aligning all of their flanking sequences
+        with one batch call per scorer, into the scoreBunch of the chunk"""
+        with self._readLock:
+            flanking = self._chunkFlankingSeqs(zmws)
+        return self.scoreFlankingSeqs(zmws, flanking)
+
+    def scoreFlankingSeqs(self, zmws, flanking):
+        """Score a chunk of ZMWs from their already extracted flanking
+        sequences, which involves no further reads"""
+        if self.prune or self.stopMargin > 0:
+            return self._scoreZmwsInRounds(zmws, flanking)
+
+        self._primeAdapters([(adapter, self._adapterDiagonals(i, scoredFirst))
+                             for seqs, scoredFirst in flanking
+                             for i, adapter in enumerate(seqs)])
+        return self.scoreFlankingRegions([zmw.holeNumber for zmw in zmws], flanking)
+
+    def _primeAdapters(self, adapters, floors = None):
+        """Prime the chunk scorers of each group with the flanks of a list of
+        (adapter, diagonals), and optionally the floors of every barcode on
+        each adapter"""
+        if floors is None:
+            floors = [None] * len(adapters)
+        for g, group in enumerate(self.barcodeGroups):
+            queries, diagonals, flankFloors = [], [], []
+            for (adapter, adapterDiagonals), floor in zip(adapters, floors):
+                if floor is not None:
+                    floor = floor[group.idxs]
+                    floor = floor if floor.max() > 0 else None
+                queries.extend(adapter[g])
+                diagonals.extend(adapterDiagonals)
+                flankFloors.extend([floor, floor])
+            for scorer in group.chunkScorers:
+                scorer.prime(queries, diagonals, flankFloors)
+
+    def _adapterDiagonals(self, i, scoredFirst):
+        # Nothing is known about where a first barcode sits in the read
+        if scoredFirst and i == 0:
+            return (None, None)
+        return self.flankDiagonals
+
+    def _scoreZmwsInRounds(self, zmws, flanking):
+        """Score a chunk of ZMWs one round of adapters at a time.  With prune,
+        each barcode is only aligned as far as it can still make the best two
+        of its ZMW given the adapters scored in the rounds before; with a
+        stopMargin, the remaining adapters of a ZMW are not scored once its
+        best barcode leads the second best by stopMargin, and only the
+        adapters scored count towards its numAdapters"""
+        numAdapters = np.array([len(seqs) for seqs, _ in flanking], dtype = int)
+        scores = np.zeros((len(zmws), numAdapters.max() if len(zmws) else 0, self.numSeqs))
+
+        def scoreRound(adapterIdxs, floors):
+            self._primeAdapters([(flanking[z][0][i], self._adapterDiagonals(i, flanking[z][1]))
+                                 for z, i in adapterIdxs], floors)
+            if adapterIdxs:
+                zs, idxs = zip(*adapterIdxs)
+                scores[zs, idxs] = self.scoreFlankingRegions.scoreAdapters(
+                    [flanking[z][0][i] for z, i in adapterIdxs])
+
+        # Until half of its adapters are scored, the remaining ones can make
+        #    up for any lead of the second best, so without a stopMargin
+        #    those are scored at once; with one, only the first adapter is
+        if self.stopMargin > 0:
+            firstRound = np.minimum(numAdapters, 1)
+        else:
+            firstRound = (numAdapters + 1) // 2
+        adapterIdxs = [(z, i) for z in xrange(len(zmws)) for i in xrange(firstRound[z])]
+        scoreRound(adapterIdxs, [None] * len(adapterIdxs))
+        numScored = firstRound.copy()
+
+        for i in xrange(firstRound.min() if len(zmws) else 0, scores.shape[1]):
+            active = np.flatnonzero((numScored == i) & (numAdapters > i))
+            if self.stopMargin > 0 and len(active):
+                active = active[self.labelMargin(scores[active, :i]) < self.stopMargin]
+            if not len(active):
+                continue
+            adapters = [flanking[z][0][i] for z in active]
+
+            # The floor of an adapter is that of its flanks, unless both are
+            #    averaged, which takes each to within maxScore of it; the
+            #    flanks of each group are those of its barcode length
+            if self.prune and i >= 1:
+                floors = self.adapterFloor(scores[active, :i], numAdapters[active])
+                bothFlanks = np.array([[l is not None and r is not None for l, r in adapter]
+                                       for adapter in adapters], dtype = bool)
+                bothFlanks = bothFlanks[:, self.barcodeGroupIdx]
+                floors = np.where(bothFlanks, 2 * floors - self.maxScores, floors)
+                floors = np.ceil(floors).astype(int)
+            else:
+                floors = None
+            scoreRound([(z, i) for z in active], floors)
+            numScored[active] += 1
+
+        # Pruning keeps the scores of the best two of each ZMW exact, but not
+        #    those of the rest, which the unpruned ranking of a tie at the top
+        #    depends on; the pruned adapters of those ZMWs are scored again
+        if self.prune and len(zmws):
+            tied = np.flatnonzero(self.tiedAtTop(scores.sum(1), scores, numScored))
+            adapterIdxs = [(z, i) for z in tied
+                           for i in xrange(max(1, firstRound[z]), numScored[z])]
+            scoreRound(adapterIdxs, [None] * len(adapterIdxs))
+
+        if self.stopMargin > 0:
+            with self._adapterStatsLock:
+                self.adapterStats.found  += int(numAdapters.sum())
+                self.adapterStats.scored += int(numScored.sum())
+
+        return Bunch(holeNums=[zmw.holeNumber for zmw in zmws], numAdapters=numScored,
+                     barcodeScores=scores.sum(1), adapterScores=scores,
+                     scoredFirst=np.array([scoredFirst for _, scoredFirst in flanking],
+                                          dtype = bool))
+
+    def logApproximationStats(self):
+        """Report the DP work saved by banding, k-mer prefiltering and
+        pruning, and how often the first two changed the best score of the
+        sampled flanks"""
+        skipped = self.aligner.cellsFull - self.aligner.cellsFilled
+        sampled = sum(scorer.sampleStats.sampled for scorer in self.chunkScorers)
+        differ  = sum(scorer.sampleStats.differ for scorer in self.chunkScorers)
+        logging.info(("Alignment (band: %d, kmerTopK: %d, prune: %r) skipped %d of %d " + \
+                          "DP cells (%.1f%%); %d of %d sampled flanks had a different " + \
+                          "best score than with the full DP") \
+                         % (self.band, self.kmerTopK, self.prune, skipped, self.aligner.cellsFull,
+                            100.0 * skipped / max(1, self.aligner.cellsFull), differ, sampled))
+
+    def labelZmwChunks(self, holeNumbers):
+        """Yield the LabeledZmwTable of input holeNumbers a chunk at a time and in
+        order, scoring chunks on a pool of nThreads threads.  At most
+        2 * nThreads chunks are scored ahead of the one being consumed, so
+        memory stays bounded however many ZMWs there are.  With prefetch,
+        the reads of up to that many chunks are done ahead by a reader
+        thread, while the chunks before them are scored."""
+        def readChunk(chunk):
+            with self._readLock:
+                zmws = [self.basH5[zmw] for zmw in chunk]
+                return (zmws, self._chunkFlankingSeqs(zmws))
+
+        def scoreChunk(chunk):
+            return self.makeLabeledZmws(self.scoreFlankingSeqs(*chunk))
+
+        chunks = prefetch((readChunk(holeNumbers[i:i + self.chunkSize])
+                           for i in xrange(0, len(holeNumbers), self.chunkSize)),
+                          self.prefetch)
+        if self.nThreads > 1:
+            pool = ThreadPool(self.nThreads)
+            try:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(scoreChunk, (chunk,)))
+                    if len(pending) > 2 * self.nThreads:
+                        yield pending.popleft().get()
+                while pending:
+                    yield pending.popleft().get()
+            finally:
+                pool.terminate()
+        else:
+            for chunk in chunks:
+                yield scoreChunk(chunk)
+
+        if self.prune or any(scorer.approximate for scorer in self.chunkScorers):
+            self.logApproximationStats()
+        if self.stopMargin > 0:
+            logging.info("Stopping at a margin of %g scored %d of %d adapters (%.1f%%)" %
+                         (self.stopMargin, self.adapterStats.scored, self.adapterStats.found,
+                          100.0 * self.adapterStats.scored / max(1, self.adapterStats.found)))
 
     def labelZmws(self, holeNumbers):
-        """Return a list of LabeledZmws for input holeNumbers"""
-        scored = [self.scoreZmw(self.basH5[zmw]) for zmw in holeNumbers]
-        return [self.makeLabeledZmw(scoreBunch) for scoreBunch in scored if scoreBunch.numAdapters]
+        """Return the LabeledZmwTable of input holeNumbers; iterating over it
+        gives their LabeledZmws"""
+        return LabeledZmwTable.concatenate([LabeledZmwTable.empty(self.numSeqs)] +
+                                           list(self.labelZmwChunks(holeNumbers)))
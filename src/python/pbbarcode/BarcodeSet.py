@@ -0,0 +1,142 @@
+#################################################################################$$
+# Copyright (c) 2011,2012, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR ITS
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################$$
+
+
+import json
+import numpy as np
+
+from pbbarcode.utils import makeBarcodeLabel, encodeSequence, reverseComplementCodes
+
+# A compiled barcode set starts with BARCODE_SET_MAGIC and the length of a
+#    JSON header (a little-endian uint64), followed by the header and then
+#    the arrays it lists, each at an offset aligned to ARRAY_ALIGNMENT
+BARCODE_SET_MAGIC = 'PBBCSET1'
+ARRAY_ALIGNMENT   = 64
+
+class BarcodeSet(object):
+    """The encoded barcodes of a barcode FASTA file (see utils.encodeSequence),
+    in both orientations, packed end to end with the barcode i spanning
+    offsets[i]:offsets[i + 1], along with their names and the labels of each
+    scoreMode.  A BarcodeSet compiled to a file (see compileBarcodes) is
+    memory-mapped read-only when loaded, so processes loading the same file
+    share its pages instead of each parsing the FASTA file."""
+    def __init__(self, names, sequences, rcSequences, offsets):
+        self.names       = list(names)
+        self.sequences   = sequences
+        self.rcSequences = rcSequences
+        self.offsets     = offsets
+
+    @classmethod
+    def fromFasta(cls, barcodeFasta):
+        """Encode the records of a FastaReader"""
+        records = list(barcodeFasta)
+        seqs = [encodeSequence(record.sequence) for record in records]
+        offsets = np.zeros(len(seqs) + 1, dtype = np.int32)
+        np.cumsum([len(seq) for seq in seqs], out = offsets[1:])
+        sequences = np.concatenate(seqs + [np.zeros(0, dtype = np.uint8)])
+        # The reverse complement of the packed sequences holds those of the
+        #    barcodes in reverse order
+        return cls([record.name for record in records], sequences,
+                   reverseComplementCodes(sequences), offsets)
+
+    @classmethod
+    def load(cls, fileName):
+        """Memory-map a compiled barcode set"""
+        with open(fileName, 'rb') as f:
+            if f.read(len(BARCODE_SET_MAGIC)) != BARCODE_SET_MAGIC:
+                raise Exception("%s is not a compiled barcode set" % fileName)
+            headerLen = int(np.frombuffer(f.read(8), dtype = '<u8')[0])
+            header = json.loads(f.read(headerLen))
+        # Plain (read-only) views of the maps slice faster than memmaps
+        arrays = dict((name, np.memmap(fileName, mode = 'r', dtype = dtype,
+                                       offset = offset,
+                                       shape = tuple(shape)).view(np.ndarray))
+                      for name, (offset, dtype, shape) in header['arrays'].items())
+        return cls([name.encode('utf-8') for name in header['names']],
+                   arrays['sequences'], arrays['rcSequences'], arrays['offsets'])
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def forward(self, i):
+        return self.sequences[self.offsets[i]:self.offsets[i + 1]]
+
+    def reverse(self, i):
+        end = len(self.sequences)
+        return self.rcSequences[end - self.offsets[i + 1]:end - self.offsets[i]]
+
+    def oriented(self, i):
+        """The barcodes of a pair (2i, 2i + 1) as they read on the forward
+        strand, the first forward and the second reverse-complemented"""
+        return self.forward(i) if (i % 2) == 0 else self.reverse(i)
+
+    def labels(self, scoreMode):
+        """The labels of the barcodes or, in paired mode, of each pair of
+        consecutive barcodes"""
+        if scoreMode == 'paired':
+            return np.array([makeBarcodeLabel(self.names[i], self.names[i + 1])
+                             for i in xrange(0, len(self.names), 2)])
+        else:
+            return np.array([makeBarcodeLabel(name, name) for name in self.names])
+
+    def write(self, fileName):
+        arrays = [('sequences', self.sequences), ('rcSequences', self.rcSequences),
+                  ('offsets', self.offsets)]
+        # The header's own length shifts the arrays, so lay them out after a
+        #    generous bound on it
+        start = len(BARCODE_SET_MAGIC) + 8 + \
+            len(json.dumps({'names': self.names})) + 256 * (len(arrays) + 1)
+        layout, offset = {}, start
+        for name, array in arrays:
+            offset = -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+            layout[name] = (offset, array.dtype.str, array.shape)
+            offset += array.nbytes
+        header = json.dumps({'names': self.names, 'arrays': layout})
+        if len(BARCODE_SET_MAGIC) + 8 + len(header) > start:
+            raise Exception("Barcode set header is too long")
+
+        with open(fileName, 'wb') as f:
+            f.write(BARCODE_SET_MAGIC)
+            f.write(np.array([len(header)], dtype = '<u8').tostring())
+            f.write(header)
+            for name, array in arrays:
+                f.seek(layout[name][0])
+                f.write(np.ascontiguousarray(array).tostring())
+
+def compileBarcodes(barcodeFasta, fileName):
+    """Compile the records of a FastaReader to a barcode set file"""
+    BarcodeSet.fromFasta(barcodeFasta).write(fileName)
+
+def isBarcodeSetFile(fileName):
+    with open(fileName, 'rb') as f:
+        return f.read(len(BARCODE_SET_MAGIC)) == BARCODE_SET_MAGIC
@@ -0,0 +1,92 @@
+#################################################################################$$
+# Copyright (c) 2011,2012, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR ITS
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################$$
+
+import numpy as np
+
+def kmerCodes(seqs, k):
+    """Return the (seqIdx, code) pairs of the distinct k-mers in each of the
+    encoded sequences (see utils.encodeSequence), where code is the 2k-bit
+    encoding of a k-mer; bases other than ACGT break a k-mer"""
+    seqs = [np.zeros(0, dtype = np.uint8) if seq is None else seq for seq in seqs]
+    lengths = np.array([len(seq) for seq in seqs], dtype = int)
+    bases = np.concatenate(seqs + [np.zeros(0, dtype = np.uint8)])
+    seqIdx = np.repeat(np.arange(len(seqs)), lengths)
+
+    nWindows = len(bases) - k + 1
+    if nWindows <= 0:
+        return (np.zeros(0, dtype = int), np.zeros(0, dtype = int))
+
+    # A window is valid when it doesn't cross sequences or unknown bases
+    invalid = np.concatenate(([0], np.cumsum(bases > 3)))
+    valid = (seqIdx[:nWindows] == seqIdx[k - 1:]) & \
+        (invalid[k:] - invalid[:nWindows] == 0)
+
+    codes = np.zeros(nWindows, dtype = int)
+    for i in xrange(0, k):
+        codes = (codes << 2) | bases[i:i + nWindows].astype(int)
+
+    pairs = np.unique(seqIdx[:nWindows][valid] * (4 ** k) + codes[valid])
+    return (pairs // (4 ** k), pairs % (4 ** k))
+
+class KmerIndex(object):
+    """An inverted index from k-mers to the (barcode) sequences containing
+    them, used to shortlist the barcodes worth aligning to a flank."""
+    def __init__(self, seqs, k = 5):
+        self.k       = k
+        self.numSeqs = len(seqs)
+
+        seqIdx, codes = kmerCodes(seqs, k)
+        order = np.argsort(codes, kind = 'mergesort')
+        self.seqIdx = seqIdx[order]
+        self.starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength = 4 ** k))))
+
+    def sharedKmers(self, queries):
+        """Return an (nQueries, numSeqs) array with the number of distinct
+        k-mers each query shares with each sequence"""
+        queryIdx, codes = kmerCodes(queries, self.k)
+        nHits = self.starts[codes + 1] - self.starts[codes]
+
+        # Expand every query k-mer into the sequences it hits
+        hitQueries = np.repeat(queryIdx, nHits)
+        firstHits = np.repeat(np.cumsum(nHits) - nHits, nHits)
+        hits = self.seqIdx[np.repeat(self.starts[codes], nHits) +
+                           np.arange(len(hitQueries)) - firstHits]
+
+        return np.bincount(hitQueries * self.numSeqs + hits,
+                           minlength = len(queries) * self.numSeqs). \
+            reshape((len(queries), self.numSeqs))
+
+    def shortlist(self, queries, topK):
+        """Return the indices of the topK sequences sharing the most k-mers
+        with each query, along with a lower bound on the alignment score of
+        every sequence: sharing a single k-mer guarantees k matches in a row."""
+        shared = self.sharedKmers(queries)
+        candidates = np.argpartition(-shared, topK - 1, axis = 1)[:, :topK]
+        lowerBounds = np.where(shared > 0, 2 * self.k, 0).astype(np.int32)
+        return (candidates.astype(np.int32), lowerBounds)
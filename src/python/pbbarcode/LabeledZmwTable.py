@@ -0,0 +1,110 @@
+#################################################################################$$
+# Copyright (c) 2011,2012, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its contributors
+#   may be used to endorse or promote products derived from this software
+#   without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR ITS
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#################################################################################$$
+
+import numpy as np
+
+from pbcore.io.BarcodeH5Reader import LabeledZmw
+
+LABEL_DTYPE = [('holeNumber', np.int32), ('nAdapters', np.int32),
+               ('bestIdx', np.int32), ('bestScore', np.float64),
+               ('secondBestIdx', np.int32), ('secondBestScore', np.float64)]
+
+class LabeledZmwTable(object):
+    """The labels of a set of ZMWs, stored column-wise: one record per ZMW
+    (LABEL_DTYPE) and the scores of every barcode on each of its adapters,
+    as the rows adapterOffsets[i]:adapterOffsets[i + 1] of a single
+    (nAdapters, numSeqs) adapterScores array.  Indexing or iterating over
+    the table gives a pbcore LabeledZmw for each ZMW, as with a list of
+    them; slicing it gives a table of those ZMWs."""
+    def __init__(self, records, adapterScores, adapterOffsets = None):
+        self.records = records
+        self.adapterScores = adapterScores
+        if adapterOffsets is None:
+            adapterOffsets = np.concatenate(([0], np.cumsum(records['nAdapters'])))
+        self.adapterOffsets = adapterOffsets
+
+    @classmethod
+    def empty(cls, numSeqs):
+        return cls(np.zeros(0, dtype = LABEL_DTYPE), np.zeros((0, numSeqs)))
+
+    @classmethod
+    def concatenate(cls, tables):
+        tables = list(tables)
+        return cls(np.concatenate([table.records for table in tables]),
+                   np.concatenate([table.adapterScores for table in tables]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def take(self, indices):
+        """The table of the ZMWs at the given (non-negative) indices"""
+        indices = np.asarray(indices, dtype = int)
+        starts = self.adapterOffsets[indices]
+        nAdapters = self.adapterOffsets[indices + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(nAdapters)))
+        rows = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], nAdapters)
+        return LabeledZmwTable(self.records[indices], self.adapterScores[rows],
+                               offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(np.arange(len(self))[i])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("LabeledZmwTable index out of range")
+        record = self.records[i]
+        return LabeledZmw(int(record['holeNumber']),
+                          int(record['nAdapters']),
+                          int(record['bestIdx']),
+                          record['bestScore'],
+                          int(record['secondBestIdx']),
+                          record['secondBestScore'],
+                          list(self.adapterScores[self.adapterOffsets[i]:
+                                                  self.adapterOffsets[i + 1]]))
+
+    def __iter__(self):
+        return (self[i] for i in xrange(0, len(self)))
+
+    def bestRecords(self):
+        """The (nZmws, 6) rows of the best dataset of a bc.h5 file"""
+        return np.column_stack([self.records[name] for name, _ in LABEL_DTYPE])
+
+    def allRecords(self):
+        """The (holeNumber, adapterIdx, barcodeIdx, score) rows of the all
+        dataset of a bc.h5 file, one per barcode of each adapter, with the
+        adapters of a ZMW numbered from 1"""
+        nAdapters = self.records['nAdapters']
+        numSeqs = self.adapterScores.shape[1]
+        adapterIdx = np.arange(len(self.adapterScores)) - \
+            np.repeat(self.adapterOffsets[:-1], nAdapters) + 1
+        return np.column_stack((np.repeat(self.records['holeNumber'], nAdapters * numSeqs),
+                                np.repeat(adapterIdx, numSeqs),
+                                np.tile(np.arange(numSeqs), len(self.adapterScores)),
+                                self.adapterScores.ravel()))
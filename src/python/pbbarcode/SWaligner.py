@@ -30,6 +30,9 @@ from ctypes import *
 import os
 import numpy
 import pkg_resources
+import threading
+
+from pbbarcode.utils import decodeSequence
 
 class SWaligner(object):
     def __init__(self, useOldWorkflow=False):
@@ -40,34 +43,192 @@ class SWaligner(object):
             self.SW_DLL_PATH = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + "sw_new.so"
         self.useOldWorkflow = useOldWorkflow
         self._dll           = CDLL(self.SW_DLL_PATH)
+        self._dll.allocate_dp_mat.restype = c_void_p
+        self._dll.compute_align_score.argtypes = [c_void_p, c_char_p, c_char_p]
+        self._dll.compute_align_scores.argtypes = [POINTER(c_int), c_int, c_void_p,
+                                                   c_char_p, POINTER(c_char_p)]
         self.dpMat          = self._dll.allocate_dp_mat()
+        # The dp row is shared by every per-target call on this instance
+        self._dpLock        = threading.Lock()
+
+        # Libraries exporting the barcode-set kernels score a query against
+        # all of the targets at once (SIMD lanes), otherwise we fall back to
+        # one DP per target.  The set kernels are reentrant and, like every
+        # ctypes call, run without the GIL so scorers may be shared by threads.
+        # Their targets and queries are encoded sequences (see utils), which
+        # are decoded again for the per-target DP.
+        self.hasBarcodeSets = hasattr(self._dll, "make_barcode_set")
+        self._barcodeSets   = []
+        if self.hasBarcodeSets:
+            self._dll.make_barcode_set.restype = c_void_p
+            self._dll.make_barcode_set.argtypes = [c_void_p, POINTER(c_int), c_int]
+            self._dll.free_barcode_set.argtypes = [c_void_p]
+            self._dll.compute_set_scores.argtypes = [POINTER(c_int), c_void_p,
+                                                     c_void_p, c_int]
+            self._dll.compute_set_scores_batch.restype = c_longlong
+            self._dll.compute_set_scores_batch.argtypes = [POINTER(c_int), c_void_p,
+                                                           c_void_p, POINTER(c_int),
+                                                           POINTER(c_int), POINTER(c_int),
+                                                           POINTER(c_int), POINTER(c_int),
+                                                           c_int, c_int]
+
+        # DP cells filled by the batch scorers versus what the full matrices
+        # would have taken, to measure banding and prefiltering.
+        self.cellsFilled    = 0
+        self.cellsFull      = 0
+        self._cellsLock     = threading.Lock()
+
+    def __del__(self):
+        if getattr(self, "dpMat", None) and hasattr(self._dll, "free_dp_mat"):
+            self._dll.free_dp_mat(c_void_p(self.dpMat))
+        for barcodeSet in getattr(self, "_barcodeSets", []):
+            self._dll.free_barcode_set(barcodeSet)
+
+    @property
+    def simdLevel(self):
+        """0 for the scalar kernels, 1 for SSE2 and 2 for AVX2"""
+        return self._dll.simd_level() if self.hasBarcodeSets else 0
 
     def score(self, tSeq, qSeq):
-        return self._dll.compute_align_score(self.dpMat, tSeq, qSeq)
+        with self._dpLock:
+            return self._dll.compute_align_score(self.dpMat, tSeq, qSeq)
+
+    def _makeBarcodeSet(self, targets):
+        offsets = numpy.zeros(len(targets) + 1, dtype = numpy.int32)
+        numpy.cumsum([len(target) for target in targets], out = offsets[1:])
+        packed = numpy.concatenate(targets + [numpy.zeros(0, dtype = numpy.uint8)])
+        barcodeSet = self._dll.make_barcode_set(packed.ctypes.data_as(c_void_p),
+                                                offsets.ctypes.data_as(POINTER(c_int)),
+                                                len(targets))
+        self._barcodeSets.append(barcodeSet)
+        return barcodeSet
 
     def makeScorer(self, targets):
-        ScoreType = c_int * len(targets)
-        scores = ScoreType()
-        for i in range(0, len(scores)):
-            scores[i] = 0
+        """Return a function scoring an encoded query against each of the
+        encoded targets; missing (None or empty) queries score 0."""
+        targetLen = len(targets)
+
+        if self.hasBarcodeSets:
+            barcodeSet = self._makeBarcodeSet(list(targets))
+
+            def scorer(query):
+                if query is None or not len(query):
+                    return numpy.zeros(targetLen)
+
+                scores = numpy.empty(targetLen, dtype = numpy.int32)
+                self._dll.compute_set_scores(scores.ctypes.data_as(POINTER(c_int)),
+                                             barcodeSet,
+                                             query.ctypes.data_as(c_void_p),
+                                             len(query))
+                return scores
+            return scorer
 
         TargetType = c_char_p * len(targets)
         targetSeqs = TargetType()
         for i in range(0, len(targetSeqs)):
-            targetSeqs[i] = targets[i]
+            targetSeqs[i] = decodeSequence(targets[i])
 
-        targetLen = len(targets)
+        ScoreType = c_int * len(targets)
+        scores = ScoreType()
+        for i in range(0, len(scores)):
+            scores[i] = 0
 
         def scorer(query):
-            if not query:
+            if query is None or not len(query):
                 return numpy.zeros(len(targets))
 
-            self._dll.compute_align_scores(scores,
-                                           targetLen,
-                                           self.dpMat,
-                                           query,
-                                           targetSeqs)
-            return numpy.array([scores[i] for i in xrange(0, len(scores))])
+            with self._dpLock:
+                self._dll.compute_align_scores(scores,
+                                               targetLen,
+                                               self.dpMat,
+                                               decodeSequence(query),
+                                               targetSeqs)
+                return numpy.array([scores[i] for i in xrange(0, len(scores))])
         return scorer
 
+    def makeBatchScorer(self, targets):
+        """Return a function scoring a list of encoded queries against all of
+        the encoded targets in a single native call.  The scores are written
+        straight into an (nQueries, nTargets) int32 array, which may be passed
+        in as 'out' to reuse it across calls; missing (None or empty) queries
+        score 0.
+
+        Given a list of 'diagonals', the expected offset of the target in
+        each query, only the cells within 'band' diagonals of it are filled
+        (the score is then a lower bound); queries whose diagonal is None, or
+        any query when band is negative, get the full DP.
+
+        Given an (nQueries, nCandidates) array of target indices as
+        'candidates', only those targets are scored for each query and the
+        other entries of 'out' are left as they were passed in; negative
+        indices are skipped.  A matching array of 'floors' lets the aligner
+        give up on a candidate as soon as it cannot score its floor, in which
+        case an upper bound below the floor is returned for it instead."""
+        targetLen = len(targets)
+
+        if not self.hasBarcodeSets:
+            scorer = self.makeScorer(targets)
+            def batchScorer(queries, out = None, diagonals = None, band = -1,
+                            candidates = None, floors = None):
+                if out is None:
+                    out = numpy.empty((len(queries), targetLen), dtype = numpy.int32)
+                for i, query in enumerate(queries):
+                    out[i] = scorer(query)
+                return out
+            return batchScorer
+
+        barcodeSet = self._makeBarcodeSet(list(targets))
+        maxTargetLen = max(map(len, targets)) if len(targets) else 0
+        noQuery = numpy.zeros(0, dtype = numpy.uint8)
+
+        def batchScorer(queries, out = None, diagonals = None, band = -1,
+                        candidates = None, floors = None):
+            queries = [noQuery if query is None else query for query in queries]
+            if out is None:
+                out = numpy.empty((len(queries), targetLen), dtype = numpy.int32)
+            elif out.dtype != numpy.int32 or not out.flags['C_CONTIGUOUS'] or \
+                    out.shape != (len(queries), targetLen):
+                raise Exception("out must be a contiguous int32 array of shape " + \
+                                    "(nQueries, nTargets)")
+            offsets = numpy.zeros(len(queries) + 1, dtype = numpy.int32)
+            numpy.cumsum([len(query) for query in queries], out = offsets[1:])
+            packed = numpy.concatenate(queries + [noQuery])
+
+            if diagonals is not None and band >= 0:
+                bands = numpy.array([-1 if d is None else band for d in diagonals],
+                                    dtype = numpy.int32)
+                diagonals = numpy.array([d or 0 for d in diagonals], dtype = numpy.int32)
+                diagonalsPtr = diagonals.ctypes.data_as(POINTER(c_int))
+                bandsPtr = bands.ctypes.data_as(POINTER(c_int))
+            else:
+                diagonalsPtr = bandsPtr = None
+
+            if candidates is not None:
+                candidates = numpy.ascontiguousarray(candidates, dtype = numpy.int32)
+                nCandidates = candidates.shape[1]
+                candidatesPtr = candidates.ctypes.data_as(POINTER(c_int))
+            else:
+                nCandidates = 0
+                candidatesPtr = None
+
+            if candidates is not None and floors is not None:
+                floors = numpy.ascontiguousarray(floors, dtype = numpy.int32)
+                floorsPtr = floors.ctypes.data_as(POINTER(c_int))
+            else:
+                floorsPtr = None
 
+            cells = self._dll.compute_set_scores_batch(out.ctypes.data_as(POINTER(c_int)),
+                                                       barcodeSet,
+                                                       packed.ctypes.data_as(c_void_p),
+                                                       offsets.ctypes.data_as(POINTER(c_int)),
+                                                       diagonalsPtr,
+                                                       bandsPtr,
+                                                       candidatesPtr,
+                                                       floorsPtr,
+                                                       nCandidates,
+                                                       len(queries))
+            with self._cellsLock:
+                self.cellsFilled += cells
+                self.cellsFull   += int(offsets[-1]) * maxTargetLen * targetLen
+            return out
+        return batchScorer
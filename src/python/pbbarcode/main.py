@@ -38,8 +38,8 @@ import re
 import subprocess
 import random
 import shutil
-
-from multiprocessing import Pool
+import time
+import resource
 
 import h5py as h5
 import numpy as n
@@ -52,6 +52,10 @@ from pbcore.io import FastaReader, FastqWriter, FastqRecord, \
     FastaWriter, FastaRecord
 
 from pbbarcode.BarcodeLabeler import *
+from pbbarcode.BarcodeH5Writer import BarcodeH5Writer, mergeBarcodeH5Files, \
+    BC_DS_PATH
+from pbbarcode.BarcodeSet import BarcodeSet, compileBarcodes, isBarcodeSetFile
+from pbbarcode.utils import prefetch, processPool, WriterPool
 from pbbarcode._version import __version__
 
 from pbh5tools.CmpH5Utils import copyAttributes
@@ -66,42 +70,80 @@ SCORE_MODES    = ['symmetric', 'paired']
 BAS_PLS_REGEX = r'\.ba[x|s]\.h5$|\.pl[x|s]\.h5$|\.cc[x|s]\.h5$'
 BARCODE_EXT   = '.bc.h5'
 BC_REGEX      = r'\.bc\.h5'
+BARCODE_SET_EXT = '.bcset'
 
 def movieNameFromFile(fn):
     return re.sub('|'.join((BC_REGEX, BAS_PLS_REGEX)) , '',
                   os.path.basename(fn))
 
-def makeBarcodeH5FromBasH5(basH5):
-    """The workhorse function for creating a barcode H5 file from a
-    base H5 file."""
-    labeler = BarcodeScorer(basH5, FastaReader(runner.args.barcodeFile),
-                            runner.args.adapterSidePad, runner.args.insertSidePad,
-                            scoreMode = runner.args.scoreMode,
-                            maxHits = runner.args.maxAdapters,
-                            scoreFirst = runner.args.scoreFirst,
-                            startTimeCutoff = runner.args.startTimeCutoff,
-                            useOldWorkflow = runner.args.old)
+# The barcodes, compiled once and memory-mapped by each process labeling
+#    ZMWs (see loadBarcodeSet)
+barcodeSet = None
+
+def loadBarcodeSet(fileName):
+    global barcodeSet
+    barcodeSet = BarcodeSet.load(fileName)
+
+def makeLabeler(basH5):
+    return BarcodeScorer(basH5, barcodeSet,
+                         runner.args.adapterSidePad, runner.args.insertSidePad,
+                         scoreMode = runner.args.scoreMode,
+                         maxHits = runner.args.maxAdapters,
+                         scoreFirst = runner.args.scoreFirst,
+                         startTimeCutoff = runner.args.startTimeCutoff,
+                         useOldWorkflow = runner.args.old,
+                         nThreads = runner.args.nThreads,
+                         band = runner.args.band,
+                         kmerSize = runner.args.kmerSize,
+                         kmerTopK = runner.args.kmerTopK,
+                         prune = runner.args.prune and not runner.args.saveExtendedInfo,
+                         stopMargin = runner.args.stopMargin,
+                         prefetch = runner.args.prefetch)
+
+def zmwsToLabel(basH5):
     if runner.args.nZmws < 0:
-        zmws = basH5.sequencingZmws
+        return basH5.sequencingZmws
     else:
-        zmws = basH5.sequencingZmws[0:runner.args.nZmws]
+        return basH5.sequencingZmws[0:runner.args.nZmws]
 
-    logging.debug("Labeling %d ZMWs from: %s" % (len(zmws), basH5.filename))
-    labeledZmws = labeler.labelZmws(zmws)
-    logging.debug("Labeled %d ZMWs" % len(labeledZmws))
+def barcodeH5FileName(basFile):
+    outBase = re.sub(BAS_PLS_REGEX, BARCODE_EXT, os.path.basename(basFile))
+    return '/'.join((runner.args.outDir, outBase))
 
-    outBase = re.sub(BAS_PLS_REGEX, BARCODE_EXT,
-                     os.path.basename(basH5.filename))
-    outFile = '/'.join((runner.args.outDir, outBase))
+def writeBarcodeH5ForZmws(basH5, zmws, outFile):
+    """Label the ZMWs of zmws, writing them to outFile"""
+    labeler = makeLabeler(basH5)
     logging.debug("Writing to: %s" % outFile)
 
-    writeBarcodeH5(labeledZmws, labeler, outFile,
-                   runner.args.saveExtendedInfo)
+    # Each chunk of labeled ZMWs is appended to the file as soon as it is
+    #    scored, rather than holding the whole movie's scores in memory
+    logging.debug("Labeling %d ZMWs from: %s" % (len(zmws), basH5.filename))
+    nLabeled = 0
+    with BarcodeH5Writer(outFile, labeler, runner.args.saveExtendedInfo,
+                         labeler.chunkSize) as writer:
+        for labeledZmws in labeler.labelZmwChunks(zmws):
+            writer.writeZmws(labeledZmws)
+            nLabeled += len(labeledZmws)
+    logging.debug("Labeled %d ZMWs" % nLabeled)
     return outFile
 
+def makeBarcodeH5FromBasH5(basH5):
+    """The workhorse function for creating a barcode H5 file from a
+    base H5 file."""
+    return writeBarcodeH5ForZmws(basH5, zmwsToLabel(basH5),
+                                 barcodeH5FileName(basH5.filename))
+
 def mpWrapper(f):
     return makeBarcodeH5FromBasH5(BasH5Reader(f))
 
+def mpTaskWrapper(task):
+    """Label the ZMWs of a task, returning who labeled them, how long it
+    took and the file they were written to"""
+    basFile, zmws, outFile = task
+    start = time.time()
+    writeBarcodeH5ForZmws(BasH5Reader(basFile), zmws, outFile)
+    return (os.getpid(), len(zmws), time.time() - start, outFile)
+
 def makeBarcodeFofnFromBasFofn():
     inputFofn = runner.args.inputFile
     inFiles = open(inputFofn).read().splitlines()
@@ -109,67 +151,234 @@ def makeBarcodeFofnFromBasFofn():
     if not all(map(os.path.exists, inFiles)):
         raise IOError("All files in input.fofn must exist.")
 
-    logging.debug("Using %d processes." % runner.args.nProcs)
-    if runner.args.nProcs <= 1:
-        newFiles = map(mpWrapper, inFiles)
+    # A barcode FASTA file is compiled once, for every process to load
+    if isBarcodeSetFile(runner.args.barcodeFile):
+        setFile, tmpSetFile = runner.args.barcodeFile, None
     else:
-        pool = Pool(runner.args.nProcs)
-        newFiles = pool.map(mpWrapper, inFiles)
+        fd, tmpSetFile = tempfile.mkstemp(suffix = BARCODE_SET_EXT,
+                                          dir = runner.args.outDir)
+        os.close(fd)
+        compileBarcodes(FastaReader(runner.args.barcodeFile), tmpSetFile)
+        setFile = tmpSetFile
+
+    logging.debug("Using %d processes." % runner.args.nProcs)
+    try:
+        if runner.args.nProcs <= 1:
+            loadBarcodeSet(setFile)
+            newFiles = map(mpWrapper, inFiles)
+        else:
+            newFiles = makeBarcodeH5sFromTasks(inFiles, setFile)
+    finally:
+        if tmpSetFile:
+            os.remove(tmpSetFile)
 
     oFile = open(runner.args.outFofn, 'w')
     for nF in newFiles:
         oFile.write(nF + "\n")
     oFile.close()
 
+# How many tasks to aim for per process, leaving room to even out the load
+TASKS_PER_PROC = 3
+
+def makeBarcodeH5sFromTasks(inFiles, setFile):
+    """Label the movies of inFiles on nProcs processes, each of which loads
+    the compiled barcodes of setFile once.  The ZMWs of each movie are split
+    into consecutive hole-number ranges (tasks) of about the same number of
+    ZMWs, a few per process across all of the movies; idle processes take
+    the next task, largest first.  A movie of one task is labeled straight
+    into its bc.h5 file; the tasks of a movie of several are labeled into
+    temporary files that are merged in order into its bc.h5 file as soon as
+    the last of them is done, so a job killed part way through leaves the
+    bc.h5 files of those movies either complete or missing, not partial"""
+    movieZmws = []
+    for inFile in inFiles:
+        basH5 = BasH5Reader(inFile)
+        movieZmws.append(zmwsToLabel(basH5))
+        basH5.close()
+    totalZmws = sum(map(len, movieZmws))
+    taskSize = max(1, -(-totalZmws // (TASKS_PER_PROC * runner.args.nProcs)))
+
+    shardDir = tempfile.mkdtemp(dir = runner.args.outDir)
+    try:
+        tasks, shardFiles, movieOfShard = [], [], {}
+        newFiles = map(barcodeH5FileName, inFiles)
+        for m, (inFile, zmws) in enumerate(zip(inFiles, movieZmws)):
+            nTasks = max(1, -(-len(zmws) // taskSize))
+            if nTasks == 1:
+                tasks.append((inFile, zmws, newFiles[m]))
+                shardFiles.append(None)
+            else:
+                shards = n.array_split(zmws, nTasks)
+                shardFiles.append(['%s/%d.%d%s' % (shardDir, m, i, BARCODE_EXT)
+                                   for i in xrange(0, nTasks)])
+                movieOfShard.update((f, m) for f in shardFiles[-1])
+                tasks.extend(zip([inFile] * nTasks, shards, shardFiles[-1]))
+        tasks.sort(key = lambda task: len(task[1]), reverse = True)
+        logging.debug("Labeling %d ZMWs from %d movies in %d tasks." %
+                      (totalZmws, len(inFiles), len(tasks)))
+
+        start = time.time()
+        nWorkers = min(runner.args.nProcs, len(tasks))
+        shardsLeft = [len(files) if files else 0 for files in shardFiles]
+        taskStats = []
+        with processPool(nWorkers, loadBarcodeSet, (setFile,)) as pool:
+            for stats in pool.imap_unordered(mpTaskWrapper, tasks, 1):
+                taskStats.append(stats[:3])
+                m = movieOfShard.get(stats[3])
+                if m is not None:
+                    shardsLeft[m] -= 1
+                    if not shardsLeft[m]:
+                        mergeBarcodeH5Files(shardFiles[m], newFiles[m])
+                        map(os.remove, shardFiles[m])
+        logWorkerUtilization(taskStats, nWorkers, time.time() - start)
+        return newFiles
+    finally:
+        shutil.rmtree(shardDir)
+
+def logWorkerUtilization(taskStats, nWorkers, elapsed):
+    """Report the share of the elapsed time each worker spent labeling"""
+    workers = {}
+    for pid, nZmws, busy in taskStats:
+        stats = workers.setdefault(pid, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += nZmws
+        stats[2] += busy
+    for pid, (nTasks, nZmws, busy) in sorted(workers.items()):
+        logging.info("Worker %d labeled %d ZMWs in %d tasks, busy %.1f%% of %.1fs" %
+                     (pid, nZmws, nTasks, 100.0 * busy / max(elapsed, 1e-9), elapsed))
+    busy = sum(stats[2] for stats in workers.values())
+    logging.info("Workers were busy %.1f%% of the time" %
+                 (100.0 * busy / max(elapsed * nWorkers, 1e-9)))
+
+# Columns of the cmp.h5 AlnIndex, the MovieInfo ID and Name datasets
+ALN_INDEX          = "AlnInfo/AlnIndex"
+ALN_INDEX_MOVIE_ID = 2
+ALN_INDEX_HOLE     = 7
+MOVIE_INFO_ID      = "MovieInfo/ID"
+MOVIE_INFO_NAME    = "MovieInfo/Name"
+
+# Number of alignments labeled (and written) at a time
+ALN_SLAB_SIZE      = 100000
+
+def barcodeH5Files(inputFofn):
+    """The bc.h5 files of a barcode.fofn, or the bc.h5 file itself"""
+    if re.search(BC_REGEX + '$', inputFofn):
+        return [inputFofn]
+    return [line for line in open(inputFofn).read().splitlines() if line]
+
+def uniqueRows(a):
+    """Return the distinct rows of a 2-D array, sorted, and the index of
+    each row of a among them"""
+    order = n.lexsort(a.T[::-1])
+    sortedRows = a[order]
+    first = n.ones(len(a), dtype = bool)
+    first[1:] = (sortedRows[1:] != sortedRows[:-1]).any(1)
+    inverse = n.empty(len(a), dtype = int)
+    inverse[order] = n.cumsum(first) - 1
+    return (sortedRows[first], inverse)
+
+def passesAlignmentFilters(best):
+    """Return which rows (labeled ZMWs) of the best dataset of a bc.h5 file
+    pass the labelAlignments filters.  The average score and score ratio are those
+    of pbcore's LabeledZmw, computed once for each distinct (nAdapters,
+    barcodeScore1, barcodeScore2) of the rows rather than once per row"""
+    keys, inverse = uniqueRows(best[:, [1, 3, 5]])
+    passes = n.zeros(len(keys), dtype = bool)
+    for i, (nScored, bestScore, secondBestScore) in enumerate(keys):
+        lZmw = LabeledZmw(0, nScored, 0, bestScore, 0, secondBestScore, [])
+        passes[i] = not (lZmw.nScored < runner.args.minNumBarcodes or
+                         lZmw.averageScore < runner.args.minAvgBarcodeScore or
+                         lZmw.scoreRatio < runner.args.minScoreRatio)
+    return passes[inverse]
+
+def makeAlignmentLabelFunc(best, nLabels):
+    """Return a function giving the AlnInfo/Barcode rows for alignments of
+    the given hole numbers, joined by hole number to the labeled ZMWs of
+    the best dataset of a bc.h5 file.  Holes without a label, or whose
+    label is filtered out, get the NULL_BARCODE."""
+    order = n.argsort(best[:, 0], kind = 'mergesort')
+    labeledHoles = best[order, 0]
+    labels = best[order][:, 1:6]
+    passes = passesAlignmentFilters(best)[order]
+    nullBarcode = n.array([0, nLabels, 0, nLabels, 0], dtype = 'int32')
+
+    def alignmentLabels(holeNumbers):
+        out = n.empty((len(holeNumbers), 5), dtype = 'int32')
+        out[:] = nullBarcode
+        if not len(labeledHoles):
+            return out
+        rows = n.minimum(n.searchsorted(labeledHoles, holeNumbers),
+                         len(labeledHoles) - 1)
+        labeled = (labeledHoles[rows] == holeNumbers) & passes[rows]
+        out[labeled] = labels[rows[labeled]]
+        return out
+    return alignmentLabels
+
 def labelAlignments():
     logging.info("Labeling alignments using: %s" % runner.args.inputFofn)
     bcFofn = BarcodeH5Fofn(runner.args.inputFofn)
 
-    with CmpH5Reader(runner.args.cmpH5) as cmpH5:
-        bcDS = n.zeros((len(cmpH5), 5), dtype = "int32")
-
-        for (i, aln) in enumerate(cmpH5):
-            bcReader = bcFofn.readerForMovie(aln.movieInfo.Name)
-            try:
-                lZmw = bcReader.labeledZmwFromHoleNumber(aln.HoleNumber)
-                if lZmw.nScored < runner.args.minNumBarcodes or \
-                        lZmw.averageScore < runner.args.minAvgBarcodeScore or \
-                        lZmw.scoreRatio < runner.args.minScoreRatio:
-                    lZmw = None
-            except KeyError:
-                lZmw = None
-
-            if lZmw:
-                bcDS[i,:] = n.array([lZmw.nScored, lZmw.bestIdx, lZmw.bestScore,
-                                     lZmw.secondBestIdx, lZmw.secondBestScore])
-            else:
-                # either no barcode was found for this guy or they got
-                # filtered, hence the NULL_BARCODE
-                bcDS[i,:] = n.array([0,
-                                     len(bcReader.barcodeLabels), 0,
-                                     len(bcReader.barcodeLabels), 0])
-
-    # write to the cmp.h5 file.
+    # The label functions of each movie's bc.h5 file
+    labelsForMovie = {}
+    for bcFile in barcodeH5Files(runner.args.inputFofn):
+        with h5.File(bcFile, 'r') as bcH5:
+            best = bcH5[BC_DS_PATH]
+            labelsForMovie[best.attrs['movieName']] = \
+                makeAlignmentLabelFunc(best[:].astype('int32'),
+                                       len(best.attrs['barcodes']))
+
+    # write to the cmp.h5 file, ALN_SLAB_SIZE alignments at a time so
+    #    that only a slab of the AlnIndex and of the barcode dataset is
+    #    ever held in memory.
     H5 = h5.File(runner.args.cmpH5, 'r+')
-    if BC_INFO_ID in H5:
-        del H5[BC_INFO_ID]
-    if BC_INFO_NAME in H5:
-        del H5[BC_INFO_NAME]
-
-    # we use the first one to get the labels, if somehow they
-    # don't have all of the same stuff that will be an issue.
-    bcLabels = n.concatenate((bcFofn.barcodeLabels, n.array([BARCODE_DELIMITER])))
-    H5.create_dataset(BC_INFO_ID, data = n.array(range(0, len(bcLabels))),
-                      dtype = 'int32')
-    H5.create_dataset(BC_INFO_NAME, data = bcLabels, dtype = h5.new_vlen(str))
-    if BC_ALN_INFO_DS in H5:
-        del H5[BC_ALN_INFO_DS]
-    bcDS = H5.create_dataset(BC_ALN_INFO_DS, data = bcDS, dtype = 'int32')
-    bcDS.attrs['ColumnNames'] = n.array(['count', 'index1', 'score1', 'index2',
-                                         'score2'])
-    #force BarcodeMode to have numpy dtype for CmpH5Sort 'extra datasets' routine
-    bcDS.attrs['BarcodeMode'] = n.array( bcFofn.scoreMode )
-    H5.close()
+    try:
+        alnIndex = H5[ALN_INDEX]
+        movieNames = dict(zip(H5[MOVIE_INFO_ID][:], H5[MOVIE_INFO_NAME][:]))
+
+        # Find the label function of every movie with alignments before
+        #    anything in the cmp.h5 file is changed
+        labelsForMovieId = {}
+        for start in xrange(0, len(alnIndex), ALN_SLAB_SIZE):
+            for movieId in n.unique(alnIndex[start:start + ALN_SLAB_SIZE,
+                                             ALN_INDEX_MOVIE_ID]):
+                movieName = movieNames[movieId]
+                if movieName not in labelsForMovie:
+                    raise Exception("No barcode.h5 file for movie: %s" % movieName)
+                labelsForMovieId[movieId] = labelsForMovie[movieName]
+
+        if BC_INFO_ID in H5:
+            del H5[BC_INFO_ID]
+        if BC_INFO_NAME in H5:
+            del H5[BC_INFO_NAME]
+
+        # we use the first one to get the labels, if somehow they
+        # don't have all of the same stuff that will be an issue.
+        bcLabels = n.concatenate((bcFofn.barcodeLabels, n.array([BARCODE_DELIMITER])))
+        H5.create_dataset(BC_INFO_ID, data = n.array(range(0, len(bcLabels))),
+                          dtype = 'int32')
+        H5.create_dataset(BC_INFO_NAME, data = bcLabels, dtype = h5.new_vlen(str))
+        if BC_ALN_INFO_DS in H5:
+            del H5[BC_ALN_INFO_DS]
+        bcDS = H5.create_dataset(BC_ALN_INFO_DS, shape = (0, 5), maxshape = (None, 5),
+                                 chunks = (max(1, min(len(alnIndex), ALN_SLAB_SIZE)), 5),
+                                 dtype = 'int32')
+        bcDS.attrs['ColumnNames'] = n.array(['count', 'index1', 'score1', 'index2',
+                                             'score2'])
+        #force BarcodeMode to have numpy dtype for CmpH5Sort 'extra datasets' routine
+        bcDS.attrs['BarcodeMode'] = n.array( bcFofn.scoreMode )
+
+        for start in xrange(0, len(alnIndex), ALN_SLAB_SIZE):
+            slab = alnIndex[start:start + ALN_SLAB_SIZE]
+            movieIds = slab[:, ALN_INDEX_MOVIE_ID]
+            holeNumbers = slab[:, ALN_INDEX_HOLE]
+            slabDS = n.empty((len(slab), 5), dtype = 'int32')
+            for movieId in n.unique(movieIds):
+                alns = movieIds == movieId
+                slabDS[alns] = labelsForMovieId[movieId](holeNumbers[alns])
+            bcDS.resize((start + len(slab), 5))
+            bcDS[start:] = slabDS
+    finally:
+        H5.close()
 
 def zipFofns(*inFofns):
     """Take inputFofns and return n tuples of length len(inFofns)
@@ -193,8 +402,9 @@ def zipFofns(*inFofns):
     # need to un-arrayify these guys
     return zip(*map(list, sortedFofns))
 
-def filterZmws(zmwsForBCs):
-    """Apply various filterings passed by the user. There are somewhat
+def makeZmwFilterFunc():
+    """Return a function applying the various filterings passed by the
+    user to a (pbcore.io.Zmw, LabeledZmw) pair. There are somewhat
     different semantics for CCS filtering and subread filtering in
     terms of the raw primary metrics available, e.g.,
     HQRegionStartTime is unavailable for the CCS data and somewhat
@@ -238,6 +448,11 @@ def filterZmws(zmwsForBCs):
         else:
             return True
 
+    return zmwFilterFx
+
+def filterZmws(zmwsForBCs):
+    """Apply the filterings passed by the user to the ZMWs of each barcode"""
+    zmwFilterFx = makeZmwFilterFunc()
     return { k:filter(zmwFilterFx, v) for k,v in zmwsForBCs.items() }
 
 def _warnOnce():
@@ -274,34 +489,73 @@ def getFastqRecords(zmw, lZmw = None):
                         read.basecalls(),
                         read.QualityValue()) for read in reads if read]
 
-def getFastqs():
-    zmwsByBarcode = getZmwsForBarcodes()
-    logging.debug("Pre-filter: Average number of ZMWs per barcode: %d" %
-                  n.mean([len(zmwsByBarcode[k]) for k in zmwsByBarcode.keys()]))
+# How many ZMWs of a barcode emitFastqs reads at a time
+FASTQ_CHUNK_SIZE = 100
 
-    zmwsByBarcode = filterZmws(zmwsByBarcode)
-    logging.debug("Post-filter: Average number of ZMWs per barcode: %d" %
-                  n.mean([len(zmwsByBarcode[k]) for k in zmwsByBarcode.keys()]))
+# Most barcode files emitFastqs keeps open at a time, and never more than
+#    half of the process's limit on open files
+MAX_OPEN_FASTQS = 256
 
-    def getReadData(zmws):
-        recs = [getFastqRecords(zmw,lZmw) for zmw,lZmw in zmws]
-        recs = filter(lambda x : x, recs)
-        return [elt for sublst in recs for elt in sublst]
-
-    return {k:getReadData(zmws) for k, zmws in zmwsByBarcode.iteritems()}
+def maxOpenFastqs():
+    softLimit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if softLimit == resource.RLIM_INFINITY:
+        return MAX_OPEN_FASTQS
+    return min(MAX_OPEN_FASTQS, softLimit // 2)
 
-def emitFastqs():
-    outFiles = getFastqs()
-    outDir   = runner.args.outDir
-    fasta    = runner.args.fasta
+# Size of the buffer used to concatenate the files of emitFastqs' processes
+FASTQ_COPY_SIZE = 16 * 1024 * 1024
 
-    if runner.args.unlabeledZmws:
-        outFiles['UNLABELED'] = getUnlabeledZmws()
+def getFastqChunks(movieFiles):
+    """Yield the (barcode label, FASTQ record) pairs of the ZMWs which pass
+    the filters, a chunk of ZMWs at a time, in a single pass over the
+    movies (bas.h5 and bc.h5 file pairs) of movieFiles: the labeled ZMWs
+    of each movie in hole-number order, followed by its unlabeled ZMWs if
+    asked for"""
+    zmwFilterFx = makeZmwFilterFunc()
+    nPreFilter, nPostFilter = {}, {}
 
-    if not os.path.exists(runner.args.outDir):
-        os.makedirs(runner.args.outDir)
-
-    if fasta:
+    def getReadData(zmws):
+        return [(label, rec) for label, zmw, lZmw in zmws
+                for rec in getFastqRecords(zmw, lZmw)]
+
+    def chunks(zmws):
+        chunk = []
+        for zmw in zmws:
+            chunk.append(zmw)
+            if len(chunk) == FASTQ_CHUNK_SIZE:
+                yield getReadData(chunk)
+                chunk = []
+        if chunk:
+            yield getReadData(chunk)
+
+    def passingZmws(basH5, bcH5):
+        for label, zmw, lZmw in getLabeledZmwsOfMovie(basH5, bcH5):
+            nPreFilter[label] = nPreFilter.get(label, 0) + 1
+            nPostFilter.setdefault(label, 0)
+            if zmwFilterFx((zmw, lZmw)):
+                nPostFilter[label] += 1
+                yield (label, zmw, lZmw)
+
+    for basH5, bcH5 in barcodedMovies(movieFiles):
+        for chunk in chunks(passingZmws(basH5, bcH5)):
+            yield chunk
+
+        if runner.args.unlabeledZmws:
+            for chunk in chunks(('UNLABELED', zmw, None) for zmw in
+                                getUnlabeledZmws(basH5, bcH5)):
+                yield chunk
+
+    # The movies of a process may have no labeled ZMWs at all
+    if nPreFilter:
+        logging.debug("Pre-filter: Average number of ZMWs per barcode: %d" %
+                      n.mean(nPreFilter.values()))
+        logging.debug("Post-filter: Average number of ZMWs per barcode: %d" %
+                      n.mean(nPostFilter.values()))
+
+def writeFastqs(movieFiles, outDir):
+    """Write the reads of the movies of movieFiles to a fast[a|q] file per
+    barcode in outDir"""
+    if runner.args.fasta:
         writer = FastaWriter
         def record(n, s, qv):
             return FastaRecord(n, s)
@@ -309,52 +563,93 @@ def emitFastqs():
         writer = FastqWriter
         record = FastqRecord
 
+    def openWriter(fileName, mode):
+        return writer(open(fileName, mode))
+
+    # The reads of the next chunks are prefetched while the current one is
+    #    trimmed and written straight to the file of its barcode; only the
+    #    most recently written files are kept open
     l = 'a' if runner.args.fasta else 'q'
-    for k in outFiles.keys():
-        if outFiles[k]:
-            with writer("%s/%s.fast%s" % (runner.args.outDir, k, l)) as w:
-                for e in outFiles[k]:
-                    tlen = len(e.sequence)-runner.args.trim
-                    r = record(e.name, e.sequence[runner.args.trim:tlen],
-                               e.quality[runner.args.trim:tlen])
-                    if r:
-                        w.writeRecord(r)
-
-def getUnlabeledZmws():
-    """Return FASTQ records for ZMWs which do not have a barcode label"""
-    unlabeledZmws = []
-
-    for basFile, barcodeFile in zipFofns(runner.args.inputFofn,
-                                         runner.args.barcodeFofn):
-        basH5 = BasH5Reader(basFile)
-        bcH5  = BarcodeH5Reader(barcodeFile)
-        sdiff = basH5.sequencingZmws[~n.in1d(basH5.sequencingZmws,
-                                             bcH5.labeledZmws.keys())]
-        for hn in sdiff:
-            unlabeledZmws.append(basH5[hn])
-
-    return reduce(lambda x,y : x+y, [getFastqRecords(unlabeledZmw) for
-                                     unlabeledZmw in unlabeledZmws])
+    with WriterPool(openWriter, maxOpenFastqs()) as writers:
+        for recs in prefetch(getFastqChunks(movieFiles), runner.args.prefetch):
+            for k, e in recs:
+                tlen = len(e.sequence)-runner.args.trim
+                r = record(e.name, e.sequence[runner.args.trim:tlen],
+                           e.quality[runner.args.trim:tlen])
+                if r:
+                    writers["%s/%s.fast%s" % (outDir, k, l)].writeRecord(r)
+
+def mpFastqsWrapper(task):
+    movieFiles, outDir = task
+    os.makedirs(outDir)
+    writeFastqs(movieFiles, outDir)
+
+def emitFastqs():
+    if not os.path.exists(runner.args.outDir):
+        os.makedirs(runner.args.outDir)
+
+    movieFiles = zipFofns(runner.args.inputFofn, runner.args.barcodeFofn)
+    nWorkers = min(runner.args.nProcs, len(movieFiles))
+    logging.debug("Using %d processes." % max(1, nWorkers))
+    if nWorkers <= 1:
+        writeFastqs(movieFiles, runner.args.outDir)
+        return
+
+    # Each process writes the files of one movie at a time to a directory
+    #    of its own, and the files of each barcode are then concatenated in
+    #    the order of the movies, just as they are written by one process.
+    shardDir = tempfile.mkdtemp(dir = runner.args.outDir)
+    try:
+        shardDirs = ['%s/%d' % (shardDir, m) for m in xrange(0, len(movieFiles))]
+        with processPool(nWorkers) as pool:
+            pool.map(mpFastqsWrapper, zip([[movie] for movie in movieFiles], shardDirs), 1)
+
+        fileNames = sorted(set(fileName for d in shardDirs for fileName in os.listdir(d)))
+        for fileName in fileNames:
+            with open('%s/%s' % (runner.args.outDir, fileName), 'wb') as outFile:
+                for d in shardDirs:
+                    if os.path.exists('%s/%s' % (d, fileName)):
+                        with open('%s/%s' % (d, fileName), 'rb') as shard:
+                            shutil.copyfileobj(shard, outFile, FASTQ_COPY_SIZE)
+    finally:
+        shutil.rmtree(shardDir)
+
+def barcodedMovies(movieFiles):
+    """Yield the BasH5Reader and BarcodeH5Reader of each of the (bas.h5
+    file, bc.h5 file) pairs of movieFiles"""
+    for basFile, barcodeFile in movieFiles:
+        yield (BasH5Reader(basFile), BarcodeH5Reader(barcodeFile))
+
+def getUnlabeledZmws(basH5, bcH5):
+    """Return the pbcore.io.Zmw of the ZMWs of a movie which do not have
+    a barcode label"""
+    sdiff = basH5.sequencingZmws[~n.in1d(basH5.sequencingZmws,
+                                         bcH5.labeledZmws.keys())]
+    return [basH5[hn] for hn in sdiff]
+
+def getLabeledZmwsOfMovie(basH5, bcH5, labels = None):
+    """Yield the barcode label, pbcore.io.Zmw and LabeledZmw of the labeled
+    ZMWs of a movie.  The holes of every label are gathered first and the
+    ZMWs are then read in order of hole number, in one sequential pass
+    over the bas.h5 file rather than one pass per label."""
+    allLabs = bcH5.barcodeLabels
+    if labels:
+        allLabs = [x for x in allLabs if x in labels]
+        logging.info("Processing only: %s" % ",".join(allLabs))
+    lZmws = [(lZmw.holeNumber, label, lZmw) for label in allLabs
+             for lZmw in bcH5.labeledZmwsFromBarcodeLabel(label)]
+    lZmws.sort(key = lambda x : x[0])
+    for holeNumber, label, lZmw in lZmws:
+        yield (label, basH5[holeNumber], lZmw)
 
 def getZmwsForBarcodes(labels = None):
     """dictionary of pbcore.io.Zmw and LabeledZmw indexed by barcode
     label"""
     zmwsForBCs = {}
-    for basFile, barcodeFile in zipFofns(runner.args.inputFofn,
-                                         runner.args.barcodeFofn):
-        basH5   = BasH5Reader(basFile)
-        bcH5    = BarcodeH5Reader(barcodeFile)
-        allLabs = bcH5.barcodeLabels
-        if labels:
-            allLabs = [x for x in allLabs if x in labels]
-            logging.info("Processing only: %s" % ",".join(allLabs))
-        for label in allLabs:
-            lZmws = bcH5.labeledZmwsFromBarcodeLabel(label)
-            for lZmw in lZmws:
-                zmw = basH5[lZmw.holeNumber]
-                if not label in zmwsForBCs.keys():
-                    zmwsForBCs[label] = []
-                zmwsForBCs[label].append((zmw, lZmw))
+    for basH5, bcH5 in barcodedMovies(zipFofns(runner.args.inputFofn,
+                                               runner.args.barcodeFofn)):
+        for label, zmw, lZmw in getLabeledZmwsOfMovie(basH5, bcH5, labels):
+            zmwsForBCs.setdefault(label, []).append((zmw, lZmw))
 
     return zmwsForBCs
 
@@ -563,8 +858,8 @@ def callConsensus():
     if runner.args.nProcs == 1:
         outFasta = filter(lambda z: z, map(gconFunc, outDirs))
     else:
-        pool = Pool(runner.args.nProcs)
-        outFasta = filter(lambda z : z, pool.map(gconFunc, outDirs))
+        with processPool(runner.args.nProcs) as pool:
+            outFasta = filter(lambda z : z, pool.map(gconFunc, outDirs))
 
     ## write the results
     with FastaWriter('/'.join((outDir, "consensus.fa"))) as w:
@@ -612,7 +907,31 @@ class Pbbarcode(PBMultiToolRunner):
         parser_m.add_argument('--nZmws', type = int, default = -1,
                               help = 'Use the first n ZMWs for testing')
         parser_m.add_argument('--nProcs', type = int, default = 8,
-                              help = 'How many processes to use')
+                              help = 'How many processes to use; movies are split ' + \
+                                  'into hole-number ranges shared between them')
+        parser_m.add_argument('--nThreads', type = int, default = 1,
+                              help = 'How many threads each process uses to align ' + \
+                                  'chunks of ZMWs')
+        parser_m.add_argument('--band', type = int, default = -1,
+                              help = 'Only align the barcodes within this many diagonals of ' + \
+                                  'where they are expected next to the adapter; a negative ' + \
+                                  'band uses the full alignment')
+        parser_m.add_argument('--kmerTopK', type = int, default = 0,
+                              help = 'Only align the kmerTopK barcodes sharing the most ' + \
+                                  'k-mers with each flank; 0 aligns all of them')
+        parser_m.add_argument('--kmerSize', type = int, default = 5,
+                              help = 'k-mer size used to shortlist barcodes with kmerTopK')
+        parser_m.add_argument('--prune', action = 'store_true', default = False,
+                              help = 'Stop aligning the barcodes which can no longer be ' + \
+                                  'among the best two of a ZMW; ignored with ' + \
+                                  'saveExtendedInfo, whose other scores it would change')
+        parser_m.add_argument('--stopMargin', type = float, default = 0,
+                              help = 'Stop scoring the adapters of a ZMW once its best ' + \
+                                  'barcode leads the second best by this score; nAdapters ' + \
+                                  'then counts the adapters scored. 0 scores them all')
+        parser_m.add_argument('--prefetch', type = int, default = 2,
+                              help = 'How many chunks of ZMWs a reader thread reads ' + \
+                                  'ahead of the ones being aligned; 0 reads them in turn')
         parser_m.add_argument('--old', action='store_true',
                               help = 'Revert to using the old Smith-Waterman binary')
         parser_m.add_argument('--saveExtendedInfo', action = 'store_true', default = False,\
@@ -620,10 +939,21 @@ class Pbbarcode(PBMultiToolRunner):
                                   'the barcode.h5 files; this information is useful for ' + \
                                   'debugging and chimera detection')
         parser_m.add_argument('barcodeFile', metavar = 'barcode.fasta',
-                              help = 'Input barcode fasta file')
+                              help = 'Input barcode fasta file, or a barcode set ' + \
+                                  'compiled from one by compileBarcodes')
         parser_m.add_argument('inputFile', metavar = 'input.fofn',
                               help = 'Input base fofn')
 
+        desc = ['Compiles a barcode fasta file into a barcode set for labelZmws.']
+        parser_c = subparsers.add_parser('compileBarcodes', description = "\n".join(desc),
+                                         help = 'Compile barcodes for labelZmws',
+                                         formatter_class = \
+                                             argparse.ArgumentDefaultsHelpFormatter)
+        parser_c.add_argument('barcodeFile', metavar = 'barcode.fasta',
+                              help = 'Input barcode fasta file')
+        parser_c.add_argument('outFile', metavar = 'barcodes.bcset',
+                              help = 'Output barcode set')
+
         def addFilteringOpts(parser, justBarcode = False):
             ## These are independent of the barcode scoring
             if not justBarcode:
@@ -688,6 +1018,12 @@ class Pbbarcode(PBMultiToolRunner):
 
         parser_s.add_argument('--trim', help = 'trim off barcodes and any excess constant sequence',
                               default = 20, type = int)
+        parser_s.add_argument('--prefetch', type = int, default = 2,
+                              help = 'How many chunks of reads a reader thread reads ' + \
+                                  'ahead of the ones being written; 0 reads them in turn')
+        parser_s.add_argument('--nProcs', type = int, default = 1,
+                              help = 'How many processes to use; each writes the reads ' + \
+                                  'of one movie at a time')
         parser_s.add_argument('--fasta', help = ('whether the files produced should be FASTA files as' +
                                                  'opposed to FASTQ'),
                               action = 'store_true',
@@ -734,6 +1070,8 @@ class Pbbarcode(PBMultiToolRunner):
 
         if self.args.subCommand == 'labelZmws':
             makeBarcodeFofnFromBasFofn()
+        elif self.args.subCommand == 'compileBarcodes':
+            compileBarcodes(FastaReader(self.args.barcodeFile), self.args.outFile)
         elif self.args.subCommand == 'labelAlignments':
             labelAlignments()
         elif self.args.subCommand == 'emitFastqs':
@@ -27,21 +27,114 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #################################################################################$$
 
+import collections
+import contextlib
+import multiprocessing
 import string
+import sys
+import threading
+import Queue
+import numpy as np
 from pbcore.io.BarcodeH5Reader import BARCODE_DELIMITER
 
 COMPLEMENT = string.maketrans('ACGTacgt-Nn','TGCAtgca-Nn')
 
+# Encoded sequences are uint8 arrays of base codes: A, C, G and T are 0 to 3
+#    and any other base is 4, which still matches itself but breaks k-mers
+BASES = np.array(list('ACGTN'))
+BASE_CODES = np.empty(256, dtype = np.uint8)
+BASE_CODES.fill(4)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
+COMPLEMENT_CODES = np.array([3, 2, 1, 0, 4], dtype = np.uint8)
+
 ### Bioinformatics Utilities ###
 
 def reverseComplement(sequence):
     return sequence.translate(COMPLEMENT)[::-1]
 
+def encodeSequence(sequence):
+    """Encode a str, or a uint8 array of ASCII basecalls, into base codes"""
+    if isinstance(sequence, str):
+        sequence = np.frombuffer(sequence, dtype = np.uint8)
+    return BASE_CODES[sequence]
+
+def decodeSequence(codes):
+    return BASES[codes].tostring()
+
+def reverseComplementCodes(codes):
+    return COMPLEMENT_CODES[codes[::-1]]
+
 ### General Utility Functions ###
 
 def makeBarcodeLabel(bc1, bc2):
     return BARCODE_DELIMITER.join((bc1, bc2))
 
+def prefetch(items, depth = 2):
+    """Iterate over items from a reader thread which runs up to depth items
+    ahead of the consumer, so that producing the next items (reading them
+    from HDF5, say) overlaps with processing the current one.  Anything
+    raised while producing an item is raised again by the consumer, and a
+    consumer stopping early stops the reader.  With a depth of 0 the items
+    are simply iterated over in the calling thread."""
+    if depth <= 0:
+        for item in items:
+            yield item
+        return
+
+    queue = Queue.Queue(depth)
+    stop  = threading.Event()
+    done  = object()
+
+    def put(entry):
+        # Give up, rather than block for good, once the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout = 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except:
+            put((None, sys.exc_info()))
+
+    reader = threading.Thread(target = read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+@contextlib.contextmanager
+def processPool(*args):
+    """A multiprocessing.Pool(*args) for the body of a with statement.  The
+    pool is closed and joined when the body is done, and terminated and
+    joined if it raises, so no worker outlives it either way."""
+    pool = multiprocessing.Pool(*args)
+    try:
+        yield pool
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
 ### General Utility Classes ###
 
 class Bunch:
@@ -52,3 +145,35 @@ class Bunch:
     """
     def __init__(self, **kwds):
         self.__dict__.update(kwds)
+
+class WriterPool(object):
+    """The writers of any number of files, at most maxOpen of which are open
+    at a time.  Asking for the writer of a file which is not open closes
+    the least recently used one first; makeWriter(fileName, mode) opens a
+    writer, truncating ('w') the first time a file is asked for and
+    appending ('a') to it after that."""
+    def __init__(self, makeWriter, maxOpen):
+        self.makeWriter = makeWriter
+        self.maxOpen    = max(1, maxOpen)
+        self._writers   = collections.OrderedDict()
+        self._opened    = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getitem__(self, fileName):
+        writer = self._writers.pop(fileName, None)
+        if writer is None:
+            if len(self._writers) >= self.maxOpen:
+                self._writers.popitem(last = False)[1].close()
+            writer = self.makeWriter(fileName, 'a' if fileName in self._opened else 'w')
+            self._opened.add(fileName)
+        self._writers[fileName] = writer
+        return writer
+
+    def close(self):
+        while self._writers:
+            self._writers.popitem()[1].close()
@@ -5,6 +5,14 @@
   $ echo $INBH51 > bas.fofn
   $ echo $INBH52 >> bas.fofn
   $ pbbarcode labelZmws $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --nThreads 4 $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --nProcs 1 $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --band 4 $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --kmerTopK 4 $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --prune $BARCODE_FASTA bas.fofn
+  $ pbbarcode labelZmws --stopMargin 40 $BARCODE_FASTA bas.fofn
+  $ pbbarcode compileBarcodes $BARCODE_FASTA barcodes.bcset
+  $ pbbarcode labelZmws barcodes.bcset bas.fofn
   $ pbbarcode labelZmws --old --scoreMode paired $BARCODE_FASTA bas.fofn
   $ pbbarcode labelZmws --old --scoreMode paired --scoreFirst $BARCODE_FASTA bas.fofn
   $ pbbarcode labelZmws --old --scoreMode paired --scoreFirst --adapterSidePad 0 --insertSidePad 0 $BARCODE_FASTA bas.fofn
@@ -13,7 +21,11 @@
   $ pbbarcode labelZmws --scoreMode paired --scoreFirst --adapterSidePad 0 --insertSidePad 0 $BARCODE_FASTA bas.fofn
   $ pbbarcode emitFastqs --fasta bas.fofn barcode.fofn
   $ pbbarcode emitFastqs --trim 20 bas.fofn barcode.fofn
+  $ pbbarcode emitFastqs --prefetch 0 --trim 20 bas.fofn barcode.fofn
   $ pbbarcode emitFastqs --subreads --trim 20 bas.fofn barcode.fofn
+  $ pbbarcode emitFastqs --outDir serial --trim 20 bas.fofn barcode.fofn
+  $ pbbarcode emitFastqs --outDir parallel --nProcs 2 --trim 20 bas.fofn barcode.fofn
+  $ diff -r serial parallel
   $ cp $INH5 ./aligned_reads.cmp.h5         
   $ chmod 766 ./aligned_reads.cmp.h5
   $ pbbarcode labelAlignments barcode.fofn aligned_reads.cmp.h5  
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from pbbarcode.BarcodeSet import BarcodeSet, compileBarcodes, isBarcodeSetFile
+from pbbarcode.utils import encodeSequence, reverseComplement
+
+
+class Record(object):
+    def __init__(self, name, sequence):
+        self.name = name
+        self.sequence = sequence
+
+
+class TestBarcodeSet(unittest.TestCase):
+    def setUp(self):
+        self.records = [Record('bc1', 'ACGTACGTAA'), Record('bc2', 'GGCATTNC'),
+                        Record('bc3', 'TTTACG'), Record('bc4', 'CAGGATTACA')]
+        fd, self.fileName = tempfile.mkstemp(suffix = '.bcset')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fileName)
+
+    def test_compiled_set_matches_fasta(self):
+        compileBarcodes(self.records, self.fileName)
+        self.assertTrue(isBarcodeSetFile(self.fileName))
+        barcodeSet = BarcodeSet.load(self.fileName)
+        self.assertFalse(barcodeSet.sequences.flags.writeable)
+        self.assertEqual(barcodeSet.names, ['bc1', 'bc2', 'bc3', 'bc4'])
+        self.assertEqual(list(barcodeSet.lengths), [10, 8, 6, 10])
+        for i, record in enumerate(self.records):
+            self.assertTrue((barcodeSet.forward(i) == encodeSequence(record.sequence)).all())
+            self.assertTrue((barcodeSet.reverse(i) ==
+                             encodeSequence(reverseComplement(record.sequence))).all())
+        self.assertTrue((barcodeSet.oriented(1) == barcodeSet.reverse(1)).all())
+        self.assertEqual(list(barcodeSet.labels('paired')), ['bc1--bc2', 'bc3--bc4'])
+
+    def test_fasta_is_not_a_barcode_set(self):
+        open(self.fileName, 'w').write('>bc1\nACGT\n')
+        self.assertFalse(isBarcodeSetFile(self.fileName))
+        self.assertRaises(Exception, BarcodeSet.load, self.fileName)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from pbbarcode.BarcodeLabeler import makeFromRangeFunc, makeBulkFromRangeFunc
+
+# (holeNumber, read length, HQ region, adapters) of a small bax.h5 file: a
+#    ZMW without adapters, adapters at either end of a read or beyond its
+#    HQ region, and more adapters than maxHits
+HOLES = [(10, 300, (0, 300), [(60, 80), (150, 170)]),
+         (11, 120, (0, 120), []),
+         (12, 250, (20, 200), [(5, 30), (100, 120), (210, 230)]),
+         (14, 400, (0, 400), [(3, 20), (60, 75), (130, 150), (220, 240),
+                              (300, 320), (385, 398)])]
+MAX_HITS = 4
+
+
+class Read(object):
+    def __init__(self, basecalls):
+        self._basecalls = basecalls
+
+    def basecalls(self):
+        return self._basecalls
+
+
+class Zmw(object):
+    """The per-ZMW view of a hole, as pbcore gives it"""
+    def __init__(self, sequence, hqRegion, adapters):
+        self.sequence = sequence
+        self.adapterRegions = [(max(s, hqRegion[0]), min(e, hqRegion[1]))
+                               for s, e in adapters
+                               if max(s, hqRegion[0]) < min(e, hqRegion[1])]
+
+    def read(self, start, end):
+        if start < 0 or end > len(self.sequence):
+            raise IndexError("read out of range")
+        return Read(self.sequence[start:end])
+
+
+class BaxH5(object):
+    def __init__(self, fileName):
+        self.file = h5py.File(fileName, 'r')
+
+
+class TestBulkFlanks(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+        self.tmpDir = tempfile.mkdtemp()
+        fileName = os.path.join(self.tmpDir, 'm.bax.h5')
+        self.zmws = {}
+        regions = {}
+        for holeNumber, length, hqRegion, adapters in HOLES:
+            sequence = ''.join(random.choice('ACGT') for _ in xrange(length))
+            self.zmws[holeNumber] = Zmw(sequence, hqRegion, adapters)
+            regions[holeNumber] = [(holeNumber, 0, s, e, 0) for s, e in adapters] + \
+                [(holeNumber, 2) + hqRegion + (0,)]
+        with h5py.File(fileName, 'w') as f:
+            f['/PulseData/BaseCalls/ZMW/HoleNumber'] = [h[0] for h in HOLES]
+            f['/PulseData/BaseCalls/ZMW/NumEvent'] = [h[1] for h in HOLES]
+            f['/PulseData/BaseCalls/Basecall'] = np.frombuffer(
+                ''.join(self.zmws[h[0]].sequence for h in HOLES), dtype = np.uint8)
+            # The Regions table is not sorted by hole number
+            f['/PulseData/Regions'] = np.array(sum([regions[h[0]] for h in HOLES[::-1]], []),
+                                               dtype = np.int32)
+            f['/PulseData/Regions'].attrs['RegionTypes'] = \
+                np.array(['Adapter', 'Insert', 'HQRegion'])
+        self.baxH5 = BaxH5(fileName)
+
+    def tearDown(self):
+        self.baxH5.file.close()
+        shutil.rmtree(self.tmpDir)
+
+    def assertSameFlanks(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            if e is None:
+                self.assertTrue(a is None)
+            else:
+                self.assertEqual(e.tolist(), a.tolist())
+
+    def test_bulk_flanks_match_reads(self):
+        """The flanks sliced out of the Basecall dataset are those read one
+        ZMW at a time, for either workflow and barcodes of two lengths"""
+        holeNumbers = [14, 11, 10, 12]
+        for useOldWorkflow in (True, False):
+            for insertSidePad, adapterSidePad in ((4, 2), (44, 0)):
+                args = ([16, 24], insertSidePad, adapterSidePad, useOldWorkflow)
+                fromRange = makeFromRangeFunc(*args)
+                bulkFromRange = makeBulkFromRangeFunc(*(args + (MAX_HITS,)))
+                bulk = bulkFromRange(self.baxH5, holeNumbers)
+                for holeNumber, adapters in zip(holeNumbers, bulk):
+                    zmw = self.zmws[holeNumber]
+                    expected = [fromRange(zmw, s, e)
+                                for s, e in zmw.adapterRegions[:MAX_HITS]]
+                    self.assertEqual(len(adapters), len(expected))
+                    for e, a in zip(expected, adapters):
+                        self.assertSameFlanks([f for pair in e for f in pair],
+                                              [f for pair in a for f in pair])
+        self.assertEqual(bulk[1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
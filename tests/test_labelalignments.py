@@ -0,0 +1,120 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from pbcore.io.BarcodeH5Reader import BarcodeH5Reader
+from pbbarcode.BarcodeH5Writer import BarcodeH5Writer
+from pbbarcode.utils import Bunch
+import pbbarcode.main as pbbarcodeMain
+
+LABELS = ['bc%d--bc%d' % (i, i) for i in xrange(0, 6)]
+MOVIES = {3: 'm000_1', 7: 'm000_2'}
+
+
+class TestLabelAlignments(unittest.TestCase):
+    def setUp(self):
+        random.seed(3)
+        self.tmpDir = tempfile.mkdtemp()
+        self.bcFofn = os.path.join(self.tmpDir, 'barcode.fofn')
+        self.cmpH5 = os.path.join(self.tmpDir, 'aligned_reads.cmp.h5')
+
+        # The labeled ZMWs of each movie, with scores giving a spread of
+        #    averages and ratios; every fifth hole has no label
+        bcFiles = []
+        for movieName in MOVIES.values():
+            best = []
+            for holeNumber in xrange(0, 200):
+                if holeNumber % 5:
+                    nAdapters = random.randint(1, 4)
+                    score1 = random.randint(0, 30 * nAdapters)
+                    best.append((holeNumber, nAdapters, random.randint(0, 5), score1,
+                                 random.randint(0, 5), random.randint(0, score1)))
+            bcFiles.append(os.path.join(self.tmpDir, movieName + '.bc.h5'))
+            labeler = Bunch(movieName = movieName, barcodeLabels = LABELS,
+                            barcodeNames = [], scoreMode = 'symmetric')
+            with BarcodeH5Writer(bcFiles[-1], labeler) as writer:
+                writer.writeRecords(np.array(best[::-1]))
+        open(self.bcFofn, 'w').write('\n'.join(bcFiles) + '\n')
+
+        # Alignments of both movies, in no particular order, including holes
+        #    missing from the bc.h5 files
+        self.alnIndex = np.zeros((500, 22), dtype = np.uint32)
+        self.alnIndex[:, 2] = [random.choice(MOVIES.keys()) for _ in xrange(0, 500)]
+        self.alnIndex[:, 7] = [random.randint(0, 220) for _ in xrange(0, 500)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def labelAlignments(self, options):
+        with h5py.File(self.cmpH5, 'w') as f:
+            f['AlnInfo/AlnIndex'] = self.alnIndex
+            f['MovieInfo/ID'] = np.array(MOVIES.keys(), dtype = np.int32)
+            f['MovieInfo/Name'] = np.array(MOVIES.values())
+        pbbarcodeMain.runner.args = pbbarcodeMain.runner.parser.parse_args(
+            ['labelAlignments'] + options + [self.bcFofn, self.cmpH5])
+        pbbarcodeMain.labelAlignments()
+        with h5py.File(self.cmpH5, 'r') as f:
+            return f['AlnInfo/Barcode'][:]
+
+    def expectedLabels(self, args):
+        """The labels of the alignments looked up one at a time"""
+        readers = dict((r.movieName, r) for r in
+                       map(BarcodeH5Reader, open(self.bcFofn).read().split()))
+        expected = np.zeros((len(self.alnIndex), 5), dtype = np.int32)
+        for i, aln in enumerate(self.alnIndex):
+            bcReader = readers[MOVIES[aln[2]]]
+            try:
+                lZmw = bcReader.labeledZmwFromHoleNumber(aln[7])
+                if lZmw.nScored < args.minNumBarcodes or \
+                        lZmw.averageScore < args.minAvgBarcodeScore or \
+                        lZmw.scoreRatio < args.minScoreRatio:
+                    lZmw = None
+            except KeyError:
+                lZmw = None
+            if lZmw:
+                expected[i] = [lZmw.nScored, lZmw.bestIdx, lZmw.bestScore,
+                               lZmw.secondBestIdx, lZmw.secondBestScore]
+            else:
+                expected[i] = [0, len(LABELS), 0, len(LABELS), 0]
+        return expected
+
+    def test_joined_labels_match_lookups(self):
+        for options in ([], ['--minAvgBarcodeScore', '10'],
+                        ['--minNumBarcodes', '2', '--minScoreRatio', '1.5']):
+            labels = self.labelAlignments(options)
+            expected = self.expectedLabels(pbbarcodeMain.runner.args)
+            self.assertTrue((labels == expected).all())
+            self.assertTrue(0 < (labels[:, 0] > 0).sum() < len(labels))
+
+    def test_missing_movie_leaves_cmp_h5_alone(self):
+        """A movie without a bc.h5 file is reported before any of the
+        barcode datasets of the cmp.h5 file are replaced"""
+        previous = self.labelAlignments([])
+        bcFiles = open(self.bcFofn).read().split()
+        open(self.bcFofn, 'w').write(bcFiles[0] + '\n')
+        pbbarcodeMain.ALN_SLAB_SIZE, slabSize = 7, pbbarcodeMain.ALN_SLAB_SIZE
+        try:
+            self.assertRaises(Exception, pbbarcodeMain.labelAlignments)
+        finally:
+            pbbarcodeMain.ALN_SLAB_SIZE = slabSize
+        with h5py.File(self.cmpH5, 'r') as f:
+            self.assertTrue((f['AlnInfo/Barcode'][:] == previous).all())
+            self.assertEqual(len(f['BarcodeInfo/ID']), len(LABELS) + 1)
+
+    def test_slabs(self):
+        slabSize = pbbarcodeMain.ALN_SLAB_SIZE
+        try:
+            pbbarcodeMain.ALN_SLAB_SIZE = 7
+            labels = self.labelAlignments([])
+        finally:
+            pbbarcodeMain.ALN_SLAB_SIZE = slabSize
+        self.assertTrue((labels == self.labelAlignments([])).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
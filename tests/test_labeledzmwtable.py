@@ -0,0 +1,38 @@
+import unittest
+
+import numpy as np
+
+from pbbarcode.LabeledZmwTable import LabeledZmwTable, LABEL_DTYPE
+
+
+class TestLabeledZmwTable(unittest.TestCase):
+    def setUp(self):
+        records = np.zeros(4, dtype = LABEL_DTYPE)
+        records['holeNumber'] = [3, 5, 8, 13]
+        records['nAdapters'] = [2, 1, 3, 2]
+        adapterScores = np.arange(8 * 2).reshape(8, 2)
+        self.table = LabeledZmwTable(records, adapterScores)
+        self.zmws = [self.table[i] for i in xrange(0, len(self.table))]
+
+    def assertSameZmw(self, a, b):
+        self.assertEqual(a.holeNumber, b.holeNumber)
+        self.assertEqual(np.asarray(a.allScores).tolist(),
+                         np.asarray(b.allScores).tolist())
+
+    def test_negative_indices(self):
+        for i in xrange(1, len(self.table) + 1):
+            self.assertSameZmw(self.table[-i], self.zmws[-i])
+        self.assertRaises(IndexError, lambda: self.table[4])
+        self.assertRaises(IndexError, lambda: self.table[-5])
+
+    def test_slices(self):
+        for s in (slice(1, 3), slice(None, None, -1), slice(0, 4, 2), slice(2, 2)):
+            sub = self.table[s]
+            self.assertTrue(isinstance(sub, LabeledZmwTable))
+            self.assertEqual(len(sub), len(self.zmws[s]))
+            for a, b in zip(sub, self.zmws[s]):
+                self.assertSameZmw(a, b)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import threading
+import unittest
+
+from pbbarcode.utils import prefetch
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_items_in_order(self):
+        for depth in (0, 1, 3):
+            self.assertEqual(list(prefetch(iter(xrange(50)), depth)), range(50))
+
+    def test_reads_in_another_thread(self):
+        def items():
+            yield threading.current_thread()
+        self.assertNotEqual(list(prefetch(items(), 2))[0], threading.current_thread())
+        self.assertEqual(list(prefetch(items(), 0))[0], threading.current_thread())
+
+    def test_errors_reach_the_consumer(self):
+        def items():
+            yield 1
+            raise IOError("unreadable")
+        self.assertRaises(IOError, list, prefetch(items(), 2))
+
+    def test_consumer_stopping_early(self):
+        read = []
+        def items():
+            for i in xrange(1000):
+                read.append(i)
+                yield i
+        chunks = prefetch(items(), 2)
+        self.assertEqual(chunks.next(), 0)
+        chunks.close()
+        self.assertTrue(len(read) < 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
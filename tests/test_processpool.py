@@ -0,0 +1,27 @@
+import multiprocessing
+import unittest
+
+from pbbarcode.utils import processPool
+
+
+def square(x):
+    return x * x
+
+
+class TestProcessPool(unittest.TestCase):
+    def test_joins_workers(self):
+        with processPool(2) as pool:
+            self.assertEqual(pool.map(square, range(5)), [0, 1, 4, 9, 16])
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_terminates_workers_on_error(self):
+        def run():
+            with processPool(2) as pool:
+                pool.map(square, range(5))
+                raise ValueError("stop")
+        self.assertRaises(ValueError, run)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import logging
+import random
+import unittest
+
+import numpy as np
+
+from pbbarcode.SWaligner import SWaligner
+from pbbarcode.utils import encodeSequence, decodeSequence, \
+    reverseComplement, reverseComplementCodes
+
+log = logging.getLogger(__name__)
+
+
+def randomSeq(length):
+    return ''.join(random.choice('ACGT') for _ in xrange(length))
+
+
+class TestSWaligner(unittest.TestCase):
+    def setUp(self):
+        random.seed(42)
+        self.aligner = SWaligner(useOldWorkflow = True)
+        self.barcodes = [randomSeq(16) for _ in xrange(40)]
+        self.codes = map(encodeSequence, self.barcodes)
+
+    def tearDown(self):
+        self.aligner._dll.set_simd_level(2)
+
+    def test_scorer_matches_scalar_kernel(self):
+        """Every kernel must agree with the per-barcode DP"""
+        scorer = self.aligner.makeScorer(self.codes)
+        queries = [randomSeq(41) for _ in xrange(20)] + [self.barcodes[3] + "ACGT"]
+        for query in queries:
+            expected = np.array([self.aligner.score(query, bc) for bc in self.barcodes])
+            for level in (2, 1, 0):
+                self.aligner._dll.set_simd_level(level)
+                self.assertTrue((scorer(encodeSequence(query)) == expected).all())
+
+    def test_empty_query(self):
+        scorer = self.aligner.makeScorer(self.codes)
+        self.assertTrue((scorer(None) == 0).all())
+        self.assertEqual(len(scorer(encodeSequence(''))), len(self.barcodes))
+
+    def test_long_sequences(self):
+        """Neither kernel is bounded by the old 64x64 matrix"""
+        barcodes = [randomSeq(100) for _ in xrange(4)]
+        scorer = self.aligner.makeScorer(map(encodeSequence, barcodes))
+        query = randomSeq(20) + barcodes[1] + randomSeq(80)
+        expected = np.array([self.aligner.score(query, bc) for bc in barcodes])
+        self.assertEqual(expected[1], 200)
+        self.assertTrue((scorer(encodeSequence(query)) == expected).all())
+
+    def test_banded_batch(self):
+        """A banded score never exceeds the full one and finds a barcode
+        sitting on the expected diagonal"""
+        batchScorer = self.aligner.makeBatchScorer(self.codes)
+        queries = [encodeSequence(randomSeq(7) + self.barcodes[i] + randomSeq(18))
+                   for i in xrange(10)]
+        full = batchScorer(queries)
+        banded = batchScorer(queries, diagonals = [7] * len(queries), band = 3)
+        self.assertTrue((banded <= full).all())
+        self.assertTrue((banded[range(10), range(10)] == 32).all())
+        self.assertTrue((batchScorer(queries, diagonals = [None] * len(queries),
+                                     band = 3) == full).all())
+
+    def test_banded_long_queries(self):
+        """The band may leave the barcode well before the end of a query
+        much longer than barcode plus band (long side pads)"""
+        for barcodes in ([randomSeq(16) for _ in xrange(40)],
+                         [randomSeq(140) for _ in xrange(4)]):
+            batchScorer = self.aligner.makeBatchScorer(map(encodeSequence, barcodes))
+            queries = [encodeSequence(randomSeq(2) + barcodes[i] + randomSeq(300))
+                       for i in xrange(len(barcodes))]
+            full = batchScorer(queries)
+            for level in (2, 1, 0):
+                self.aligner._dll.set_simd_level(level)
+                banded = batchScorer(queries, diagonals = [2] * len(queries), band = 2)
+                self.assertTrue((banded <= full).all())
+                self.assertTrue((banded.diagonal() == 2 * len(barcodes[0])).all())
+
+    def test_candidate_batch(self):
+        """Only the shortlisted targets are scored, the rest keep 'out'"""
+        batchScorer = self.aligner.makeBatchScorer(self.codes)
+        queries = [encodeSequence(randomSeq(7) + self.barcodes[i] + randomSeq(18))
+                   for i in xrange(10)]
+        full = batchScorer(queries)
+        candidates = np.array([[i, (i + 5) % 40] for i in xrange(10)])
+        out = np.zeros((10, 40), dtype = np.int32)
+        scores = batchScorer(queries, out = out, candidates = candidates)
+        rows = np.arange(10)[:, None]
+        self.assertTrue((scores[rows, candidates] == full[rows, candidates]).all())
+        self.assertEqual(scores.sum(), full[rows, candidates].sum())
+
+    def test_candidate_floors(self):
+        """Candidates reaching their floor are exact, the others may be
+        replaced by a bound between their score and their floor"""
+        batchScorer = self.aligner.makeBatchScorer(self.codes)
+        queries = [encodeSequence(randomSeq(7) + self.barcodes[i] + randomSeq(18))
+                   for i in xrange(10)]
+        full = batchScorer(queries)
+        candidates = np.tile(np.arange(40), (10, 1))
+        floors = np.tile(np.arange(40) % 4 * 10, (10, 1))
+        for level in (2, 1, 0):
+            self.aligner._dll.set_simd_level(level)
+            scores = batchScorer(queries, candidates = candidates, floors = floors)
+            self.assertTrue((scores[full >= floors] == full[full >= floors]).all())
+            self.assertTrue((scores >= full).all())
+            self.assertTrue(((scores == full) | (scores < floors)).all())
+
+    def test_encoded_sequences(self):
+        """Encoding is lossless for ACGT and the reverse complement of the
+        codes matches that of the string"""
+        seq = randomSeq(30) + "N" + randomSeq(5)
+        codes = encodeSequence(seq)
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(decodeSequence(codes), seq)
+        self.assertEqual(decodeSequence(reverseComplementCodes(codes)),
+                         reverseComplement(seq))
+        self.assertTrue((encodeSequence(np.frombuffer(seq.lower(), dtype = np.uint8)) ==
+                         codes).all())
@@ -0,0 +1,50 @@
+import unittest
+
+from pbbarcode.utils import WriterPool
+
+
+class FakeWriter(object):
+    def __init__(self, files, fileName, mode):
+        self.files, self.fileName = files, fileName
+        if mode == 'w':
+            files[fileName] = []
+        self.closed = False
+
+    def writeRecord(self, record):
+        self.files[self.fileName].append(record)
+
+    def close(self):
+        self.closed = True
+
+
+class TestWriterPool(unittest.TestCase):
+    def setUp(self):
+        self.files = {}
+        self.opened = []
+        def makeWriter(fileName, mode):
+            self.opened.append((fileName, mode))
+            return FakeWriter(self.files, fileName, mode)
+        self.pool = WriterPool(makeWriter, 2)
+
+    def test_reopens_closed_files_for_appending(self):
+        for fileName in ['a', 'b', 'c', 'a', 'b']:
+            self.pool[fileName].writeRecord(fileName)
+        self.pool.close()
+        self.assertEqual(self.files, {'a': ['a', 'a'], 'b': ['b', 'b'], 'c': ['c']})
+        self.assertEqual(self.opened, [('a', 'w'), ('b', 'w'), ('c', 'w'),
+                                       ('a', 'a'), ('b', 'a')])
+
+    def test_closes_least_recently_used(self):
+        a = self.pool['a']
+        b = self.pool['b']
+        self.pool['a']
+        self.pool['c']
+        self.assertFalse(a.closed)
+        self.assertTrue(b.closed)
+        with self.pool:
+            pass
+        self.assertTrue(a.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()